@@ -0,0 +1,190 @@
+"""
+チャットの処理時間をオフラインで計測するベンチマーク。
+
+Streamlit の AppTest で main() を動かし、保存先は遅延を入れた SQLite（Supabase の代わり）、
+Gemini は fakes.FakeGenerativeModel に差し替える。履歴の件数ごとに次の値を出力する。
+
+* 最初の表示（ログイン直後のフルリラン）にかかった時間
+* チャット 1 ターンのリランにかかった時間（AppTest 上のフルリラン全体）
+* そのうちチャットのフラグメント（chat_turn_pane）の処理時間（metrics の rerun.chat_turn）
+* 1 ターンあたりの保存先への往復回数（バックグラウンドの書き込みを含む）
+* 最初のトークンまでの時間とストリーム全体の時間
+* st.session_state のおおよそのメモリ量
+
+AppTest はフラグメントだけのリランを再現できず、チャットの入力でも常にスクリプト全体をリランする。
+実際のアプリではチャットのターンはフラグメントのリランになるため、「1ターン ms」はサイドバーなど
+フラグメントの外の処理を含む上限の値で、フラグメントのリランの時間には「チャット区間 ms」を見る。
+
+使い方:
+    python benchmark.py --sizes 10 100 1000 10000 --db-delay 0.02 --first-token-delay 0.3
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+from unittest import mock
+
+from streamlit.testing.v1 import AppTest
+import google.generativeai as genai
+import streamlit as st
+
+import fakes
+import metrics
+import storage
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_app.py")
+
+
+def deep_sizeof(obj, seen=None):
+    """オブジェクトが参照しているものも含めたおおよそのメモリ量（バイト）"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(vars(obj), seen)
+    return size
+
+
+def seed_history(backend, user_id, count):
+    """count 件の過去メッセージを、古いものから 1 秒間隔の時刻で追加する"""
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    rows = [
+        {
+            'user_id': user_id,
+            'role': 'user' if i % 2 else 'assistant',
+            'content': f"過去のメッセージ {i}: " + "今日は学習日記の振り返りをしました。" * 3,
+            'timestamp': (start + datetime.timedelta(seconds=i)).isoformat(),
+        }
+        for i in range(count)
+    ]
+    backend.insert_messages(rows)
+
+
+def wait_for_writes(latency_storage, quiet_seconds=1.0, timeout=30.0):
+    """バックグラウンドの書き込みが落ち着く（quiet_seconds の間、往復が増えない）まで待つ"""
+    deadline = time.monotonic() + timeout
+    last = latency_storage.round_trips
+    last_change = time.monotonic()
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        current = latency_storage.round_trips
+        if current != last:
+            last, last_change = current, time.monotonic()
+        elif time.monotonic() - last_change >= quiet_seconds:
+            return
+
+
+def run_scenario(history_size, args):
+    """履歴が history_size 件あるユーザーで、ログイン直後の表示とチャット数ターンを計測する"""
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    fakes.FakeGenerativeModel.configure(
+        first_token_delay=args.first_token_delay,
+        chunk_delay=args.chunk_delay,
+    )
+
+    backend = storage.SQLiteStorage(':memory:')
+    backend.add_user('bench', 'x')
+    user_id = backend.get_user('bench')['id']
+    seed_history(backend, user_id, history_size)
+    latency_storage = fakes.LatencyStorage(backend, delay=args.db_delay)
+
+    with mock.patch.object(storage, 'SQLiteStorage', lambda path: latency_storage), \
+            mock.patch.object(genai, 'GenerativeModel', fakes.FakeGenerativeModel), \
+            mock.patch.object(genai, 'configure', lambda **kwargs: None):
+        at = AppTest.from_file(APP_PATH, default_timeout=args.timeout)
+        at.secrets['storage_backend'] = 'sqlite'
+        at.secrets['google_api_key'] = 'benchmark'
+        at.session_state['logged_in'] = True
+        at.session_state['username'] = 'bench'
+        at.session_state['user_id'] = user_id
+        at.session_state['is_admin'] = False
+
+        started = time.perf_counter()
+        at.run()
+        first_render = time.perf_counter() - started
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+        # 計測の記録先は AppTest で動かすアプリと同じモジュールなので、ターンの分だけを集計できる
+        metrics.recorder.clear()
+
+        turn_times = []
+        round_trips = []
+        ttfts = []
+        stream_totals = []
+        for turn in range(args.turns):
+            before = latency_storage.round_trips
+            started = time.perf_counter()
+            at.chat_input[0].set_value(f"ベンチマークの入力 {turn}: 今日は新しい単語を覚えました。").run()
+            turn_times.append(time.perf_counter() - started)
+            if at.exception:
+                raise RuntimeError(at.exception[0].value)
+            wait_for_writes(latency_storage)
+            round_trips.append(latency_storage.round_trips - before)
+            stats = at.session_state['last_stream_stats']
+            ttfts.append(stats['time_to_first_token'])
+            stream_totals.append(stats['total'])
+
+        state_bytes = deep_sizeof(at.session_state.to_dict())
+        spans = {row['name']: row for row in metrics.recorder.summary()}
+
+    return {
+        'history': history_size,
+        'first_render_ms': first_render * 1000,
+        'turn_ms': _median(turn_times) * 1000,
+        'fragment_ms': spans['rerun.chat_turn']['p50'] if 'rerun.chat_turn' in spans else 0,
+        'round_trips': _median(round_trips),
+        'ttft_ms': _median(ttfts) * 1000,
+        'stream_ms': _median(stream_totals) * 1000,
+        'state_kb': state_bytes / 1024,
+    }
+
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return 0
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000], help="計測する履歴の件数")
+    parser.add_argument('--turns', type=int, default=3, help="履歴の件数ごとのチャットのターン数")
+    parser.add_argument('--db-delay', type=float, default=0.02, help="保存先への 1 往復あたりの遅延（秒）")
+    parser.add_argument('--first-token-delay', type=float, default=0.3, help="Gemini の最初のチャンクまでの遅延（秒）")
+    parser.add_argument('--chunk-delay', type=float, default=0.01, help="Gemini のチャンク間の遅延（秒）")
+    parser.add_argument('--timeout', type=float, default=120, help="1 回のリランのタイムアウト（秒）")
+    args = parser.parse_args()
+
+    columns = [
+        ('history', "履歴件数", "{:d}"),
+        ('first_render_ms', "初回表示 ms", "{:.0f}"),
+        ('turn_ms', "1ターン ms", "{:.0f}"),
+        ('fragment_ms', "チャット区間 ms", "{:.0f}"),
+        ('round_trips', "DB往復/ターン", "{:.1f}"),
+        ('ttft_ms', "TTFT ms", "{:.0f}"),
+        ('stream_ms', "ストリーム ms", "{:.0f}"),
+        ('state_kb', "session_state KB", "{:.1f}"),
+    ]
+    print("| " + " | ".join(title for _, title, _ in columns) + " |")
+    print("|" + "---|" * len(columns))
+    for size in args.sizes:
+        result = run_scenario(size, args)
+        print("| " + " | ".join(fmt.format(result[key]) for key, _, fmt in columns) + " |", flush=True)
+    print()
+    print("「1ターン ms」は AppTest のフルリラン全体の時間。フラグメントのリランの時間は「チャット区間 ms」（rerun.chat_turn の中央値）。")
+
+
+if __name__ == '__main__':
+    main()
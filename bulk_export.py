@@ -0,0 +1,103 @@
+"""
+研究用の全ユーザーのチャット履歴の一括エクスポート。
+履歴は保存先からキーセット（timestamp, id）でページ単位に読み、1 ページずつファイルに書き出すので、
+件数が増えてもメモリに載るのは 1 ページ分だけになる。
+"""
+import csv
+import hashlib
+import io
+import json
+import zipfile
+
+# 保存先から 1 回に読み込む行数
+EXPORT_PAGE_SIZE = 1000
+# 書き出す列
+EXPORT_COLUMNS = ('id', 'user_id', 'username', 'role', 'content', 'timestamp')
+
+
+def iter_message_pages(storage, page_size=EXPORT_PAGE_SIZE, after=None, since=None, until=None, user_ids=None):
+    """
+    条件に合うチャット履歴を古い順に、最大 page_size 件ずつのリストとして返すジェネレーター。
+    保存先が 1 回に返す行数に上限（Supabase の db-max-rows など）があると page_size より短いページが
+    途中でも返るので、最後かどうかはページの長さではなく、空のページが返るかどうかで判断する。
+    """
+    while True:
+        rows = storage.get_messages_page(page_size, after, since, until, user_ids)
+        if not rows:
+            return
+        yield rows
+        after = (rows[-1]['timestamp'], rows[-1]['id'])
+
+
+def checkpoint_name(user_ids=None):
+    """
+    対象ユーザーごとのチェックポイント名。同じユーザーを対象にしたエクスポートは前回の続きから書き出す。
+    期間はチェックポイントに含めず、その上にかける絞り込みとして扱う。
+    """
+    conditions = json.dumps({'user_ids': sorted(str(user_id) for user_id in user_ids or [])})
+    return "chat_history:" + hashlib.sha256(conditions.encode('utf-8')).hexdigest()[:16]
+
+
+class ExportResult:
+    """書き出した行数と、最後に書き出した行の (timestamp, id)（次回のチェックポイント）"""
+
+    def __init__(self):
+        self.rows = 0
+        self.last = None
+
+    def add(self, rows):
+        self.rows += len(rows)
+        self.last = (rows[-1]['timestamp'], rows[-1]['id'])
+
+
+def write_csv_zip(pages, fileobj, on_page=None):
+    """
+    pages の行を CSV（Excel で開けるよう BOM 付き UTF-8）にして、ZIP 圧縮しながら fileobj に書き出す。
+    ページを書き終えるたびに on_page(ExportResult) を呼ぶ。
+    """
+    result = ExportResult()
+    with zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with io.TextIOWrapper(archive.open('chat_history.csv', 'w', force_zip64=True), encoding='utf-8-sig', newline='') as text:
+            writer = csv.writer(text)
+            writer.writerow(EXPORT_COLUMNS)
+            for rows in pages:
+                writer.writerows([row.get(column) for column in EXPORT_COLUMNS] for row in rows)
+                result.add(rows)
+                if on_page is not None:
+                    on_page(result)
+    return result
+
+
+def write_parquet(pages, fileobj, on_page=None):
+    """
+    pages の行を Parquet として fileobj に書き出す。1 ページが 1 つの行グループになる。
+    pyarrow が必要（インストールされていなければ ImportError）。
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('user_id', pa.string()),
+        ('username', pa.string()),
+        ('role', pa.string()),
+        ('content', pa.string()),
+        ('timestamp', pa.string()),
+    ])
+    result = ExportResult()
+    with pq.ParquetWriter(fileobj, schema, compression='zstd') as writer:
+        for rows in pages:
+            columns = {column: [row.get(column) for row in rows] for column in EXPORT_COLUMNS}
+            columns['user_id'] = [None if user_id is None else str(user_id) for user_id in columns['user_id']]
+            writer.write_table(pa.table(columns, schema=schema))
+            result.add(rows)
+            if on_page is not None:
+                on_page(result)
+    return result
+
+
+# 形式ごとの書き出し関数・ファイル名・MIME タイプ
+EXPORT_FORMATS = {
+    "CSV (ZIP)": (write_csv_zip, "chat_history.zip", "application/zip"),
+    "Parquet": (write_parquet, "chat_history.parquet", "application/vnd.apache.parquet"),
+}
@@ -0,0 +1,125 @@
+"""
+Gemini 呼び出しの同時実行数の制限と順番待ち。
+授業中に多くの学習者が一斉に送信しても、プロセス全体で同時に実行する呼び出しを一定数に抑え、
+待っている呼び出しはユーザーごとに順番に（1 人が連続して枠を使い続けないように）実行する。
+"""
+import collections
+import random
+import threading
+import time
+
+import metrics
+
+# 同時に実行する Gemini 呼び出しの既定数
+DEFAULT_MAX_CONCURRENCY = 8
+# レート制限エラーのときの再試行回数と待ち時間の基準（秒）
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_BACKOFF = 1.0
+# 順番待ちの表示を更新する間隔（秒）
+POSITION_POLL_INTERVAL = 0.5
+
+
+def is_rate_limit_error(error):
+    """Gemini のレート制限（HTTP 429 / RESOURCE_EXHAUSTED）によるエラーかどうか"""
+    if type(error).__name__ in ('ResourceExhausted', 'TooManyRequests'):
+        return True
+    code = getattr(error, 'code', None)
+    return code == 429 or getattr(code, 'value', None) == 429
+
+
+class _Ticket:
+    def __init__(self, user_key):
+        self.user_key = user_key
+        self.granted = False
+
+
+class LLMDispatcher:
+    """
+    同時実行数を max_concurrency に制限する順番待ちの窓口。
+    待っている呼び出しはユーザーごとの列に並び、空いた枠はユーザーを順に回って割り当てる。
+    """
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.active = 0
+        self.rate_limited = 0
+        self._queues = collections.OrderedDict()
+        self._condition = threading.Condition()
+
+    def _position(self, ticket):
+        """ticket の前に実行される呼び出しの数（ユーザーを順に回る割り当て順で数える）"""
+        queues = [list(tickets) for tickets in self._queues.values()]
+        position = 0
+        for round_index in range(max(len(tickets) for tickets in queues)):
+            for tickets in queues:
+                if round_index < len(tickets):
+                    if tickets[round_index] is ticket:
+                        return position
+                    position += 1
+        return position
+
+    def _grant(self):
+        """空いている枠を、待っているユーザーに順番に割り当てる"""
+        while self.active < self.max_concurrency and self._queues:
+            user_key, tickets = next(iter(self._queues.items()))
+            ticket = tickets.popleft()
+            # 割り当てたユーザーは最後尾に回す
+            del self._queues[user_key]
+            if tickets:
+                self._queues[user_key] = tickets
+            ticket.granted = True
+            self.active += 1
+        self._condition.notify_all()
+
+    def acquire(self, user_key, on_wait=None):
+        """
+        枠が空くまで待つ。待っている間は on_wait(前に並んでいる数) を、数が変わるたびに呼ぶ。
+        待った時間は dispatcher.wait として記録する。戻り値は release に渡すチケット。
+        """
+        ticket = _Ticket(user_key)
+        with metrics.span("dispatcher.wait"), self._condition:
+            self._queues.setdefault(user_key, collections.deque()).append(ticket)
+            self._grant()
+            last_position = None
+            while not ticket.granted:
+                position = self._position(ticket)
+                if on_wait is not None and position != last_position:
+                    last_position = position
+                    self._condition.release()
+                    try:
+                        on_wait(position)
+                    finally:
+                        self._condition.acquire()
+                    continue
+                self._condition.wait(POSITION_POLL_INTERVAL)
+        return ticket
+
+    def release(self, ticket):
+        with self._condition:
+            if ticket.granted:
+                ticket.granted = False
+                self.active -= 1
+                self._grant()
+
+    def call(self, user_key, func, on_wait=None):
+        """
+        枠を確保して func() を実行し、その戻り値を返す。
+        レート制限エラーの場合は、ゆらぎを加えた指数バックオフで最大 max_retries 回まで再試行する。
+        """
+        ticket = self.acquire(user_key, on_wait)
+        try:
+            attempt = 0
+            while True:
+                try:
+                    return func()
+                except Exception as e:
+                    if not is_rate_limit_error(e) or attempt >= self.max_retries:
+                        raise
+                    with self._condition:
+                        self.rate_limited += 1
+                    time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+                    attempt += 1
+        finally:
+            self.release(ticket)
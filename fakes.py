@@ -0,0 +1,183 @@
+"""
+オフライン検証用のフェイククライアント。
+ネットワークや API キーなしで、キャッシュのヒット／ミスなどの挙動の確認やベンチマーク（benchmark.py）に使う。
+"""
+import collections
+import itertools
+import json
+import threading
+import time
+
+
+class FakeCachedContent:
+    """CachedContent の代わりに使う、登録内容を保持するだけのオブジェクト"""
+
+    def __init__(self, name, model_name, system_instruction, contents, ttl_seconds):
+        self.name = name
+        self.model = model_name
+        self.system_instruction = system_instruction
+        self.contents = contents
+        self.ttl_seconds = ttl_seconds
+
+
+class FakeResponse:
+    """generate_content の戻り値の代わり"""
+
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeCachedModel:
+    """キャッシュ済みコンテキストから作られたモデルの代わり。受け取った内容を記録する"""
+
+    def __init__(self, cached_content):
+        self.cached_content = cached_content
+        self.calls = []
+
+    def generate_content(self, contents, stream=False):
+        self.calls.append(contents)
+        return FakeResponse(f"（{self.cached_content.name} を使った応答）")
+
+
+class FakeCachingClient:
+    """
+    ContextCacheRegistry に渡せるフェイクのキャッシュクライアント。
+    create が呼ばれた回数（＝キャッシュミス）を created で確認できる。
+    min_chars を指定すると、それより短い内容の登録は Gemini と同様のエラー（"Cached content is too small"）で失敗する。
+    fail_next に例外を入れておくと、次の create だけその例外で失敗する（一時的なエラーの再現用）。
+    """
+
+    def __init__(self, min_chars=0):
+        self.min_chars = min_chars
+        self.fail_next = None
+        self.created = []
+        self._ids = itertools.count(1)
+
+    def create(self, model_name, system_instruction, contents, ttl_seconds):
+        if self.fail_next is not None:
+            error, self.fail_next = self.fail_next, None
+            raise error
+        size = len(system_instruction) + sum(len(part) for content in contents for part in content['parts'])
+        if size < self.min_chars:
+            raise ValueError(f"Cached content is too small. total_token_count={size}, min_total_token_count={self.min_chars}")
+        cached_content = FakeCachedContent(
+            f"cachedContents/fake-{next(self._ids)}", model_name, system_instruction, contents, ttl_seconds
+        )
+        self.created.append(cached_content)
+        return cached_content
+
+    def model_from_cache(self, cached_content):
+        return FakeCachedModel(cached_content)
+
+
+class FakeChunk:
+    """ストリーミング応答の 1 チャンクの代わり"""
+
+    def __init__(self, text):
+        self.parts = [FakePart(text)]
+        self.text = text
+
+
+class FakePart:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeUsageMetadata:
+    def __init__(self, prompt_token_count):
+        self.prompt_token_count = prompt_token_count
+
+
+class FakeStreamResponse:
+    """generate_content(stream=True) の戻り値の代わり。反復すると遅延を入れながらチャンクを返す"""
+
+    def __init__(self, chunks, first_token_delay, chunk_delay, prompt_token_count):
+        self._chunks = chunks
+        self._first_token_delay = first_token_delay
+        self._chunk_delay = chunk_delay
+        self.usage_metadata = FakeUsageMetadata(prompt_token_count)
+
+    def __iter__(self):
+        for index, text in enumerate(self._chunks):
+            time.sleep(self._first_token_delay if index == 0 else self._chunk_delay)
+            yield FakeChunk(text)
+
+
+class FakeGenerativeModel:
+    """
+    genai.GenerativeModel の代わり。決まった応答を、設定した遅延をはさんで返す。
+    遅延と応答は FakeGenerativeModel.configure で変更する。
+    """
+
+    reply = "今日の学習で一番印象に残ったことは何ですか？" * 10
+    chunk_chars = 20
+    first_token_delay = 0.0
+    chunk_delay = 0.0
+    instances = 0
+    calls = 0
+
+    def __init__(self, model_name='gemini-2.5-flash', system_instruction=None, generation_config=None):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.generation_config = generation_config
+        FakeGenerativeModel.instances += 1
+
+    @classmethod
+    def configure(cls, reply=None, chunk_chars=None, first_token_delay=None, chunk_delay=None):
+        if reply is not None:
+            cls.reply = reply
+        if chunk_chars is not None:
+            cls.chunk_chars = chunk_chars
+        if first_token_delay is not None:
+            cls.first_token_delay = first_token_delay
+        if chunk_delay is not None:
+            cls.chunk_delay = chunk_delay
+        cls.instances = 0
+        cls.calls = 0
+
+    @classmethod
+    def from_cached_content(cls, cached_content, **kwargs):
+        return cls(getattr(cached_content, 'model', 'gemini-2.5-flash'))
+
+    def generate_content(self, contents, stream=False):
+        FakeGenerativeModel.calls += 1
+        prompt_chars = len(str(contents)) + len(self.system_instruction or "")
+        if self.generation_config and self.generation_config.get("response_mime_type") == "application/json":
+            text = json.dumps({"challenge": "（フェイク）課題", "achievement": "（フェイク）達成"}, ensure_ascii=False)
+        else:
+            text = self.reply
+        if not stream:
+            time.sleep(self.first_token_delay)
+            return FakeResponse(text)
+        chunks = [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)]
+        return FakeStreamResponse(chunks, self.first_token_delay, self.chunk_delay, prompt_chars)
+
+
+class LatencyStorage:
+    """
+    保存先（storage.ChatStorage）の前に置き、呼び出しごとに一定の遅延を入れて回数を数える。
+    SQLiteStorage(':memory:') と組み合わせて、Supabase へのネットワーク往復の代わりに使う。
+    """
+
+    def __init__(self, backend, delay=0.0):
+        self.backend = backend
+        self.delay = delay
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def round_trips(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+        if not callable(method):
+            return method
+
+        def call(*args, **kwargs):
+            with self._lock:
+                self.calls[name] += 1
+            time.sleep(self.delay)
+            return method(*args, **kwargs)
+        return call
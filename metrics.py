@@ -0,0 +1,114 @@
+"""
+ホットパスの処理時間の計測。
+計測した区間（スパン）と、トークン数などの処理時間以外の値はプロセス内に直近の一定件数だけ保持し、
+名前ごとのパーセンタイルを集計する。
+管理者ダッシュボードでの表示と、JSON Lines 形式での書き出しに使う。
+"""
+import collections
+import contextlib
+import functools
+import json
+import math
+import threading
+import time
+
+# 名前ごとに保持する直近のスパン数
+WINDOW_SIZE = 1000
+# JSON Lines として書き出せるよう、全体で保持する直近のスパン数
+LOG_SIZE = 10000
+
+
+class SpanRecorder:
+    """スパンの記録と集計。複数のセッションやバックグラウンドスレッドから同時に使える"""
+
+    def __init__(self, window_size=WINDOW_SIZE, log_size=LOG_SIZE):
+        self.window_size = window_size
+        self._values = {}
+        self._units = {}
+        self._log = collections.deque(maxlen=log_size)
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, **attrs):
+        """name の区間に seconds 秒かかったことを記録する"""
+        entry = {'ts': time.time(), 'name': name, 'ms': round(seconds * 1000, 3)}
+        self._append(name, seconds * 1000, 'ms', entry, attrs)
+
+    def observe(self, name, value, unit, **attrs):
+        """処理時間以外の値（トークン数など）を unit の単位で記録する"""
+        entry = {'ts': time.time(), 'name': name, 'value': value, 'unit': unit}
+        self._append(name, value, unit, entry, attrs)
+
+    def _append(self, name, value, unit, entry, attrs):
+        if attrs:
+            entry.update(attrs)
+        with self._lock:
+            values = self._values.get(name)
+            if values is None:
+                values = self._values[name] = collections.deque(maxlen=self.window_size)
+            values.append(value)
+            self._units[name] = unit
+            self._log.append(entry)
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """with ブロックの処理時間を name として記録する（例外で抜けた場合も記録する）"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started, **attrs)
+
+    def timed(self, name):
+        """関数の呼び出しごとの処理時間を name として記録するデコレーター"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """名前ごとの件数・単位（スパンは ms）と p50 / p90 / p99 / 最大を名前順に返す"""
+        with self._lock:
+            windows = {name: sorted(values) for name, values in self._values.items()}
+            units = dict(self._units)
+        rows = []
+        for name in sorted(windows):
+            values = windows[name]
+            rows.append({
+                'name': name,
+                'unit': units[name],
+                'count': len(values),
+                'p50': _percentile(values, 50),
+                'p90': _percentile(values, 90),
+                'p99': _percentile(values, 99),
+                'max': values[-1],
+            })
+        return rows
+
+    def to_jsonl(self):
+        """保持している直近のスパンを JSON Lines 形式の文字列で返す"""
+        with self._lock:
+            entries = list(self._log)
+        return "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._units.clear()
+            self._log.clear()
+
+
+def _percentile(sorted_values, percent):
+    """最近傍法によるパーセンタイル"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+# プロセス全体で共有する記録先
+recorder = SpanRecorder()
+span = recorder.span
+timed = recorder.timed
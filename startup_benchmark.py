@@ -0,0 +1,121 @@
+"""
+アプリのコールドスタートを計測するベンチマーク。
+
+新しい Python プロセスで Streamlit の AppTest を使ってアプリを 1 回表示し、次の値を出力する。
+プロセスごとに 1 回だけ計測するので、モジュールの読み込みもすべて計測に含まれる。
+
+* Streamlit 本体の読み込みにかかった時間
+* アプリの最初の表示（アプリのモジュールの読み込みを含む）にかかった時間
+* 表示後のプロセスのメモリ使用量（RSS）
+* 表示の時点で読み込まれていた重い依存パッケージ
+
+画面はログイン画面と、履歴のない学習者のチャット画面の 2 つ。保存先は一時ファイルの SQLite を使い、ネットワークにはつながない。
+計測には psutil が必要。
+
+使い方:
+    python startup_benchmark.py --runs 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_app.py")
+# 読み込まれているかどうかを確認するパッケージ
+HEAVY_MODULES = ('pandas', 'docx', 'google.generativeai', 'pyarrow')
+SCREENS = ('login', 'learner')
+
+
+def measure(screen, db_path):
+    """このプロセスで screen の画面を 1 回表示し、計測値を返す"""
+    import psutil
+    process = psutil.Process()
+    started = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    framework = time.perf_counter() - started
+    framework_rss = process.memory_info().rss
+
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    import storage
+    backend = storage.SQLiteStorage(db_path)
+    if backend.get_user('startup') is None:
+        backend.add_user('startup', 'x')
+    user_id = backend.get_user('startup')['id']
+
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    at.secrets['storage_backend'] = 'sqlite'
+    at.secrets['sqlite_path'] = db_path
+    at.secrets['google_api_key'] = 'startup-benchmark'
+    if screen == 'learner':
+        at.session_state['logged_in'] = True
+        at.session_state['username'] = 'startup'
+        at.session_state['user_id'] = user_id
+        at.session_state['is_admin'] = False
+    started = time.perf_counter()
+    at.run()
+    first_render = time.perf_counter() - started
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    return {
+        'screen': screen,
+        'framework_ms': framework * 1000,
+        'first_render_ms': first_render * 1000,
+        'framework_rss_mb': framework_rss / 2 ** 20,
+        'rss_mb': process.memory_info().rss / 2 ** 20,
+        'loaded': [name for name in HEAVY_MODULES if name in sys.modules],
+    }
+
+
+def run_child(screen, db_path):
+    """新しいプロセスで measure を実行し、その結果を返す"""
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', screen, '--db', db_path],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument('--runs', type=int, default=5, help="画面ごとの計測回数（中央値を出力する）")
+    parser.add_argument('--child', choices=SCREENS, help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args.db)))
+        return
+
+    columns = [
+        ('screen', "画面", "{}"),
+        ('framework_ms', "Streamlit 読み込み ms", "{:.0f}"),
+        ('first_render_ms', "初回表示 ms", "{:.0f}"),
+        ('framework_rss_mb', "Streamlit 読み込み後 RSS MB", "{:.1f}"),
+        ('rss_mb', "初回表示後 RSS MB", "{:.1f}"),
+        ('loaded', "読み込み済みの依存", "{}"),
+    ]
+    print("| " + " | ".join(title for _, title, _ in columns) + " |")
+    print("|" + "---|" * len(columns))
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'startup.db')
+        for screen in SCREENS:
+            results = [run_child(screen, db_path) for _ in range(args.runs)]
+            row = {key: _median([result[key] for result in results]) for key, _, _ in columns[1:-1]}
+            row['screen'] = screen
+            row['loaded'] = ", ".join(results[-1]['loaded']) or "-"
+            print("| " + " | ".join(fmt.format(row[key]) for key, _, fmt in columns) + " |", flush=True)
+
+
+if __name__ == '__main__':
+    main()
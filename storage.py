@@ -0,0 +1,542 @@
+"""
+ユーザー・チャット履歴・学習記録の保存先。
+アプリは ChatStorage のメソッドだけを使い、保存先（Supabase / SQLite）は設定で切り替える。
+"""
+import abc
+import collections
+import datetime
+import sqlite3
+import threading
+import time
+
+
+# キャッシュした履歴を、保存先に確かめずにそのまま返す時間（秒）
+DEFAULT_HISTORY_CACHE_TTL = 10
+
+
+def _escape_like(text):
+    """LIKE / ILIKE のパターンとして使えるよう、ワイルドカード文字をエスケープする"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# 再試行すれば成功する見込みのある PostgreSQL のエラーコードの分類（接続・トランザクションの競合・資源不足など）
+_TRANSIENT_SQLSTATE_CLASSES = ('08', '40', '53', '57', '58')
+# 接続やプールの待ち時間切れを表す PostgREST のエラーコード
+_TRANSIENT_POSTGREST_CODES = ('PGRST000', 'PGRST001', 'PGRST002', 'PGRST003')
+
+
+def is_transient_error(error):
+    """
+    保存先への書き込みエラーのうち、再試行すれば成功する見込みのあるもの（通信エラー・タイムアウト・ロック待ちなど）かどうか。
+    制約違反や不正なデータ、4xx など、同じ内容で再試行しても失敗するものは False を返す。
+    判別できないエラーは一時的なものとして扱う。
+    """
+    if isinstance(error, sqlite3.OperationalError):
+        message = str(error)
+        return 'locked' in message or 'busy' in message
+    if isinstance(error, (sqlite3.IntegrityError, sqlite3.InterfaceError, sqlite3.ProgrammingError, sqlite3.DataError)):
+        return False
+    code = getattr(error, 'code', None)
+    if not isinstance(code, str):
+        return True
+    if code.isdigit() and len(code) == 3:
+        # SQLSTATE ではなく HTTP ステータスの場合
+        return code in ('408', '429') or code.startswith('5')
+    if code.startswith('PGRST'):
+        return code in _TRANSIENT_POSTGREST_CODES
+    if len(code) == 5:
+        return code[:2] in _TRANSIENT_SQLSTATE_CLASSES
+    return True
+
+
+def _message_key(row):
+    """履歴のカーソル比較に使う (timestamp, id)"""
+    return (row['timestamp'], row['id'])
+
+
+class ChatStorage(abc.ABC):
+    """保存先の共通インターフェース。失敗した場合は例外を送出する"""
+
+    @abc.abstractmethod
+    def add_user(self, username, password_hash, is_admin=False):
+        """ユーザーを追加する"""
+
+    @abc.abstractmethod
+    def get_user(self, username):
+        """ユーザー名に一致するユーザー（id, username, password_hash, is_admin）を返す。いなければ None"""
+
+    @abc.abstractmethod
+    def user_directory(self, search, offset, limit):
+        """
+        管理者以外のユーザーを検索・ページ単位で取得し、(ユーザーのリスト, 該当ユーザーの総数) を返す。
+        各ユーザーは id, username, message_count, last_activity, session_count を持つ。
+        """
+
+    @abc.abstractmethod
+    def insert_messages(self, rows):
+        """
+        チャット履歴を複数行まとめて追加し、id が付いた行を返す。
+        client_id を持つ行は、同じ client_id の行が既にあれば追加しない（戻り値にも含めない）。
+        書き込みの結果が分からないまま再試行しても、行が重複しないようにするため。
+        """
+
+    @abc.abstractmethod
+    def get_messages(self, user_id, limit, before=None):
+        """
+        ユーザーのチャット履歴（id, role, content, timestamp）を新しい順に limit 件返す。
+        before に (timestamp, id) を渡すと、それより古いものだけを返す。
+        """
+
+    @abc.abstractmethod
+    def get_messages_page(self, limit, after=None, since=None, until=None, user_ids=None):
+        """
+        全ユーザーのチャット履歴（id, user_id, username, role, content, timestamp）を古い順に limit 件返す。
+        after に (timestamp, id) を渡すとそれより新しいものだけを返す。
+        since / until（ISO 8601 文字列）で期間を、user_ids でユーザーを絞り込む。
+        """
+
+    @abc.abstractmethod
+    def get_export_checkpoint(self, name):
+        """name のエクスポートで最後に書き出した行の (timestamp, id) を返す。なければ None"""
+
+    @abc.abstractmethod
+    def set_export_checkpoint(self, name, checkpoint):
+        """name のエクスポートで最後に書き出した行の (timestamp, id) を保存する"""
+
+    @abc.abstractmethod
+    def latest_learning_summary(self, user_id):
+        """最新の学習記録（challenge, achievement）を返す。なければ None"""
+
+    @abc.abstractmethod
+    def insert_learning_summary(self, user_id, challenge, achievement):
+        """学習記録を 1 行追加する"""
+
+
+class SupabaseStorage(ChatStorage):
+    """Supabase（PostgREST）に保存する"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def add_user(self, username, password_hash, is_admin=False):
+        self.client.table('users').insert({
+            'username': username,
+            'password_hash': password_hash,
+            'is_admin': is_admin
+        }).execute()
+
+    def get_user(self, username):
+        response = self.client.table('users').select('*').eq('username', username).execute()
+        return response.data[0] if response.data else None
+
+    def user_directory(self, search, offset, limit):
+        # 件数・最終利用日時・学習記録数は埋め込みリソースとして同じ 1 回のクエリで取得する
+        query = self.client.table('users').select(
+            'id, username, message_count:chat_history(count), last_message:chat_history(timestamp), session_count:learning_summaries(count)',
+            count='exact'
+        ).eq('is_admin', False)
+        if search:
+            query = query.ilike('username', f'%{_escape_like(search)}%')
+        response = (
+            query.order('username')
+            .order('timestamp', desc=True, foreign_table='last_message')
+            .limit(1, foreign_table='last_message')
+            .range(offset, offset + limit - 1)
+            .execute()
+        )
+        users = []
+        for row in response.data:
+            last_message = row.get('last_message') or []
+            users.append({
+                'id': row['id'],
+                'username': row['username'],
+                'message_count': (row.get('message_count') or [{'count': 0}])[0]['count'],
+                'last_activity': last_message[0]['timestamp'] if last_message else None,
+                'session_count': (row.get('session_count') or [{'count': 0}])[0]['count'],
+            })
+        return users, response.count or 0
+
+    def insert_messages(self, rows):
+        if all(row.get('client_id') for row in rows):
+            response = self.client.table('chat_history').upsert(rows, on_conflict='client_id', ignore_duplicates=True).execute()
+        else:
+            response = self.client.table('chat_history').insert(rows).execute()
+        return response.data
+
+    def get_messages(self, user_id, limit, before=None):
+        query = self.client.table('chat_history').select('id, role, content, timestamp').eq('user_id', user_id)
+        if before is not None:
+            ts, msg_id = before
+            query = query.or_(f'timestamp.lt."{ts}",and(timestamp.eq."{ts}",id.lt.{msg_id})')
+        response = query.order('timestamp', desc=True).order('id', desc=True).limit(limit).execute()
+        return response.data or []
+
+    def get_messages_page(self, limit, after=None, since=None, until=None, user_ids=None):
+        query = self.client.table('chat_history').select('id, user_id, role, content, timestamp, users(username)')
+        if after is not None:
+            ts, msg_id = after
+            query = query.or_(f'timestamp.gt."{ts}",and(timestamp.eq."{ts}",id.gt.{msg_id})')
+        if since is not None:
+            query = query.gte('timestamp', since)
+        if until is not None:
+            query = query.lt('timestamp', until)
+        if user_ids:
+            query = query.in_('user_id', list(user_ids))
+        response = query.order('timestamp').order('id').limit(limit).execute()
+        rows = []
+        for row in response.data or []:
+            user = row.pop('users', None) or {}
+            row['username'] = user.get('username')
+            rows.append(row)
+        return rows
+
+    def get_export_checkpoint(self, name):
+        response = self.client.table('export_checkpoints').select('last_timestamp, last_id').eq('name', name).execute()
+        if not response.data:
+            return None
+        return (response.data[0]['last_timestamp'], response.data[0]['last_id'])
+
+    def set_export_checkpoint(self, name, checkpoint):
+        self.client.table('export_checkpoints').upsert({
+            'name': name,
+            'last_timestamp': checkpoint[0],
+            'last_id': checkpoint[1],
+            'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat()
+        }).execute()
+
+    def latest_learning_summary(self, user_id):
+        response = self.client.table('learning_summaries').select('challenge, achievement').eq('user_id', user_id).order('created_at', desc=True).limit(1).execute()
+        return response.data[0] if response.data else None
+
+    def insert_learning_summary(self, user_id, challenge, achievement):
+        self.client.table('learning_summaries').insert({
+            'user_id': user_id,
+            'challenge': challenge,
+            'achievement': achievement
+        }).execute()
+
+
+class SQLiteStorage(ChatStorage):
+    """
+    ローカルの SQLite ファイルに保存する。ネットワークなしでアプリを動かしたり負荷試験をしたりするときに使う。
+    テーブルは Supabase（supabase/migrations の SQL で作成する）と同じ構成で、初回接続時に作成する。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL UNIQUE,
+        password_hash TEXT NOT NULL,
+        is_admin INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        client_id TEXT
+    );
+    CREATE INDEX IF NOT EXISTS chat_history_user_timestamp ON chat_history (user_id, timestamp, id);
+    CREATE TABLE IF NOT EXISTS learning_summaries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        challenge TEXT,
+        achievement TEXT,
+        created_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS learning_summaries_user_created ON learning_summaries (user_id, created_at);
+    CREATE INDEX IF NOT EXISTS chat_history_timestamp ON chat_history (timestamp, id);
+    CREATE TABLE IF NOT EXISTS export_checkpoints (
+        name TEXT PRIMARY KEY,
+        last_timestamp TEXT NOT NULL,
+        last_id INTEGER NOT NULL
+    );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.executescript(self.SCHEMA)
+            # client_id を追加する前に作られたファイルにも列と索引を足す
+            columns = [row['name'] for row in self._conn.execute("PRAGMA table_info(chat_history)")]
+            if 'client_id' not in columns:
+                self._conn.execute("ALTER TABLE chat_history ADD COLUMN client_id TEXT")
+            self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS chat_history_client_id ON chat_history (client_id)")
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, params).fetchall()]
+
+    def add_user(self, username, password_hash, is_admin=False):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)",
+                (username, password_hash, int(is_admin))
+            )
+
+    def get_user(self, username):
+        rows = self._query("SELECT * FROM users WHERE username = ?", (username,))
+        if not rows:
+            return None
+        user = rows[0]
+        user['is_admin'] = bool(user['is_admin'])
+        return user
+
+    def user_directory(self, search, offset, limit):
+        rows = self._query(
+            """
+            SELECT u.id, u.username,
+                (SELECT COUNT(*) FROM chat_history c WHERE c.user_id = u.id) AS message_count,
+                (SELECT MAX(c.timestamp) FROM chat_history c WHERE c.user_id = u.id) AS last_activity,
+                (SELECT COUNT(*) FROM learning_summaries s WHERE s.user_id = u.id) AS session_count,
+                COUNT(*) OVER () AS total
+            FROM users u
+            WHERE u.is_admin = 0 AND u.username LIKE ? ESCAPE '\\'
+            ORDER BY u.username
+            LIMIT ? OFFSET ?
+            """,
+            (f'%{_escape_like(search or "")}%', limit, offset)
+        )
+        total = rows[0]['total'] if rows else 0
+        for row in rows:
+            del row['total']
+        return rows, total
+
+    def insert_messages(self, rows):
+        inserted = []
+        with self._lock, self._conn:
+            for row in rows:
+                timestamp = row.get('timestamp') or self._now()
+                cursor = self._conn.execute(
+                    "INSERT INTO chat_history (user_id, role, content, timestamp, client_id) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (client_id) DO NOTHING",
+                    (row['user_id'], row['role'], row['content'], timestamp, row.get('client_id'))
+                )
+                if cursor.rowcount:
+                    inserted.append(dict(row, id=cursor.lastrowid, timestamp=timestamp))
+        return inserted
+
+    def get_messages(self, user_id, limit, before=None):
+        if before is None:
+            return self._query(
+                "SELECT id, role, content, timestamp FROM chat_history WHERE user_id = ? "
+                "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (user_id, limit)
+            )
+        ts, msg_id = before
+        return self._query(
+            "SELECT id, role, content, timestamp FROM chat_history WHERE user_id = ? "
+            "AND (timestamp < ? OR (timestamp = ? AND id < ?)) "
+            "ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (user_id, ts, ts, msg_id, limit)
+        )
+
+    def get_messages_page(self, limit, after=None, since=None, until=None, user_ids=None):
+        conditions = []
+        params = []
+        if after is not None:
+            conditions.append("(c.timestamp > ? OR (c.timestamp = ? AND c.id > ?))")
+            params.extend([after[0], after[0], after[1]])
+        if since is not None:
+            conditions.append("c.timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("c.timestamp < ?")
+            params.append(until)
+        if user_ids:
+            user_ids = list(user_ids)
+            conditions.append(f"c.user_id IN ({', '.join('?' for _ in user_ids)})")
+            params.extend(user_ids)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._query(
+            "SELECT c.id, c.user_id, u.username, c.role, c.content, c.timestamp "
+            "FROM chat_history c LEFT JOIN users u ON u.id = c.user_id "
+            f"{where} ORDER BY c.timestamp, c.id LIMIT ?",
+            (*params, limit)
+        )
+
+    def get_export_checkpoint(self, name):
+        rows = self._query("SELECT last_timestamp, last_id FROM export_checkpoints WHERE name = ?", (name,))
+        return (rows[0]['last_timestamp'], rows[0]['last_id']) if rows else None
+
+    def set_export_checkpoint(self, name, checkpoint):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO export_checkpoints (name, last_timestamp, last_id) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET last_timestamp = excluded.last_timestamp, last_id = excluded.last_id",
+                (name, checkpoint[0], checkpoint[1])
+            )
+
+    def latest_learning_summary(self, user_id):
+        rows = self._query(
+            "SELECT challenge, achievement FROM learning_summaries WHERE user_id = ? "
+            "ORDER BY created_at DESC LIMIT 1",
+            (user_id,)
+        )
+        return rows[0] if rows else None
+
+    def insert_learning_summary(self, user_id, challenge, achievement):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO learning_summaries (user_id, challenge, achievement, created_at) VALUES (?, ?, ?, ?)",
+                (user_id, challenge, achievement, self._now())
+            )
+
+
+class _CachedHistory:
+    """1 ユーザー分の、新しい順に連続して読み込んだ履歴"""
+
+    def __init__(self):
+        self.rows = []
+        # True のとき、rows より古い履歴は存在しない
+        self.complete = False
+        # 最新の行が保存先と同じであることを最後に確かめた時刻（time.monotonic）
+        self.validated_at = time.monotonic()
+
+    def slice(self, limit, before):
+        """キャッシュだけで応えられる場合は該当する行を、応えられない場合は None を返す"""
+        if before is None:
+            start = 0
+        else:
+            keys = [_message_key(row) for row in self.rows]
+            if tuple(before) not in keys:
+                return None
+            start = keys.index(tuple(before)) + 1
+        if start + limit <= len(self.rows) or self.complete:
+            return self.rows[start:start + limit]
+        return None
+
+    def extend(self, before, rows, limit):
+        """
+        保存先から読み込んだページを、キャッシュと連続している場合だけ取り込む。
+        before がキャッシュの途中の行でもよい（limit + 1 件ずつ読む場合、カーソルは末尾の 1 つ手前の行になる）。
+        その場合は before より古い側を読み込んだページで置き換える。
+        """
+        if before is None:
+            self.rows = list(rows)
+            self.validated_at = time.monotonic()
+        else:
+            keys = [_message_key(row) for row in self.rows]
+            if tuple(before) not in keys:
+                return
+            self.rows = self.rows[:keys.index(tuple(before)) + 1] + list(rows)
+        self.complete = len(rows) < limit
+
+
+class CachedStorage(ChatStorage):
+    """
+    保存先の前に置く読み取りキャッシュ。
+    チャット履歴はユーザーごとに新しい側から連続した範囲をメモリに保持して同じ読み込みに応え（read-through）、
+    追加したメッセージは保存先に書き込んだうえでキャッシュの先頭にも反映する（write-through）。
+    他のプロセス（別のレプリカなど）が追加した行を見落とさないよう、ttl_seconds を過ぎたキャッシュは
+    返す前に保存先の最新の 1 行と比べ、違っていれば捨てて読み込み直す。
+    それ以外の操作はそのまま保存先に渡す。
+    """
+
+    def __init__(self, backend, max_users=256, max_rows_per_user=1000, ttl_seconds=DEFAULT_HISTORY_CACHE_TTL):
+        self.backend = backend
+        self.max_users = max_users
+        self.max_rows_per_user = max_rows_per_user
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._history = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add_user(self, username, password_hash, is_admin=False):
+        return self.backend.add_user(username, password_hash, is_admin)
+
+    def get_user(self, username):
+        return self.backend.get_user(username)
+
+    def user_directory(self, search, offset, limit):
+        return self.backend.user_directory(search, offset, limit)
+
+    def get_messages_page(self, limit, after=None, since=None, until=None, user_ids=None):
+        return self.backend.get_messages_page(limit, after, since, until, user_ids)
+
+    def get_export_checkpoint(self, name):
+        return self.backend.get_export_checkpoint(name)
+
+    def set_export_checkpoint(self, name, checkpoint):
+        return self.backend.set_export_checkpoint(name, checkpoint)
+
+    def latest_learning_summary(self, user_id):
+        return self.backend.latest_learning_summary(user_id)
+
+    def insert_learning_summary(self, user_id, challenge, achievement):
+        return self.backend.insert_learning_summary(user_id, challenge, achievement)
+
+    def _trim(self, entry):
+        if len(entry.rows) > self.max_rows_per_user:
+            del entry.rows[self.max_rows_per_user:]
+            entry.complete = False
+
+    def _is_current(self, user_id, entry):
+        """キャッシュの最新の行が、保存先の最新の行と同じかどうか"""
+        newest = self.backend.get_messages(user_id, 1)
+        return [_message_key(row) for row in newest] == [_message_key(row) for row in entry.rows[:1]]
+
+    def get_messages(self, user_id, limit, before=None):
+        stale = None
+        with self._lock:
+            entry = self._history.get(user_id)
+            if entry is not None:
+                rows = entry.slice(limit, before)
+                if rows is not None:
+                    self._history.move_to_end(user_id)
+                    if time.monotonic() - entry.validated_at < self.ttl_seconds:
+                        self.hits += 1
+                        return [dict(row) for row in rows]
+                    stale = entry
+
+        if stale is not None:
+            current = self._is_current(user_id, stale)
+            with self._lock:
+                if current:
+                    stale.validated_at = time.monotonic()
+                    self.hits += 1
+                    return [dict(row) for row in rows]
+                if self._history.get(user_id) is stale:
+                    del self._history[user_id]
+
+        with self._lock:
+            self.misses += 1
+
+        rows = self.backend.get_messages(user_id, limit, before)
+
+        with self._lock:
+            entry = self._history.get(user_id)
+            if entry is None and before is None:
+                entry = self._history[user_id] = _CachedHistory()
+                while len(self._history) > self.max_users:
+                    self._history.popitem(last=False)
+            if entry is not None:
+                entry.extend(before, rows, limit)
+                self._trim(entry)
+                self._history.move_to_end(user_id)
+        return [dict(row) for row in rows]
+
+    def insert_messages(self, rows):
+        inserted = self.backend.insert_messages(rows)
+        with self._lock:
+            for row in inserted:
+                entry = self._history.get(row['user_id'])
+                if entry is None:
+                    continue
+                cached = {key: row[key] for key in ('id', 'role', 'content', 'timestamp')}
+                # 追加したメッセージは通常最も新しいので、新しい順の位置に差し込む
+                position = 0
+                while position < len(entry.rows) and _message_key(entry.rows[position]) > _message_key(cached):
+                    position += 1
+                entry.rows.insert(position, cached)
+                self._trim(entry)
+        return inserted
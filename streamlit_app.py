@@ -1,14 +1,39 @@
 import streamlit as st
-from supabase import create_client, Client
+from supabase import create_client
 import hashlib
 import sys
 import io
-import docx
-import pandas as pd
-import google.generativeai as genai
-import os 
+import string
+import collections
+import csv
+import time
+import datetime
+import threading
+import queue
+import atexit
+import json
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from storage import ChatStorage, SupabaseStorage, SQLiteStorage, CachedStorage, DEFAULT_HISTORY_CACHE_TTL, is_transient_error
+import metrics
+import bulk_export
+from dispatcher import LLMDispatcher, DEFAULT_MAX_CONCURRENCY, is_rate_limit_error
 
-# --- Supabase データベース設定 ---
+# 画面に表示する時刻と研究用エクスポートの期間指定に使うタイムゾーン（履歴の時刻は UTC で保存している）
+EXPORT_TIMEZONE = datetime.timezone(datetime.timedelta(hours=9))
+
+def format_timestamp(value):
+    """保存先の ISO 8601 の時刻を、日本時間の「YYYY-MM-DD HH:MM」にする"""
+    try:
+        parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return value[:16].replace('T', ' ')
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.astimezone(EXPORT_TIMEZONE).strftime('%Y-%m-%d %H:%M')
+
+# --- データベース設定 ---
 
 @st.cache_resource 
 def init_supabase_client():
@@ -21,124 +46,1388 @@ def init_supabase_client():
         st.error("Supabase の URL または Key が Streamlit Secrets に設定されていません。")
         st.stop()
 
+@st.cache_resource
+def init_storage():
+    """
+    Streamlit Secrets の storage_backend（"supabase" または "sqlite"）に応じて保存先を初期化し、
+    読み取りキャッシュを付けて返す。SQLite のファイルは sqlite_path で、
+    キャッシュした履歴を保存先に確かめずに返す時間（秒）は history_cache_ttl で指定する。
+    """
+    if st.secrets.get("storage_backend", "supabase") == "sqlite":
+        backend = SQLiteStorage(st.secrets.get("sqlite_path", "taiwa.db"))
+    else:
+        backend = SupabaseStorage(init_supabase_client())
+    return CachedStorage(backend, ttl_seconds=st.secrets.get("history_cache_ttl", DEFAULT_HISTORY_CACHE_TTL))
+
 def hash_password(password):
     """パスワードをハッシュ化する"""
     return hashlib.sha256(password.encode()).hexdigest()
 
-def add_user(supabase: Client, username, password):
-    """一般ユーザーを Supabase に追加する"""
+@metrics.timed("db.add_user")
+def add_user(storage: ChatStorage, username, password):
+    """一般ユーザーを追加する"""
     if username.lower() == 'adminkaho1020':
         return False
     try:
-        supabase.table('users').insert({
-            'username': username,
-            'password_hash': hash_password(password),
-            'is_admin': False
-        }).execute()
+        storage.add_user(username, hash_password(password), is_admin=False)
         return True
     except Exception as e:
         st.error(f"不明なエラーが発生しました: {e}")
         return False
 
-def verify_user(supabase: Client, username, password):
+@metrics.timed("db.verify_user")
+def verify_user(storage: ChatStorage, username, password):
     """ユーザーを認証する"""
     try:
-        response = supabase.table('users').select('*').eq('username', username).execute()
-        if response.data:
-            user = response.data[0]
-            if user['password_hash'] == hash_password(password):
-                return user
+        user = storage.get_user(username)
+        if user and user['password_hash'] == hash_password(password):
+            return user
         return None
     except Exception as e:
         st.error(f"認証エラー: {e}")
         return None
 
-def get_all_users(supabase: Client):
-    """管理者以外の全ユーザーを取得する"""
+class ChatHistoryWriter:
+    """
+    チャット履歴をキューに溜め、バックグラウンドスレッドから複数行まとめて保存先に書き込む。
+    一時的なエラーで失敗したバッチは指数バックオフで再試行し（各行の client_id により、前回の書き込みが
+    実は成功していても重複しない）、制約違反などのエラーの場合はバッチを分けて
+    原因の行以外を書き込む。書き込めずに破棄した行の数は failed_rows / failed_by_user で確認できる。
+    """
+
+    def __init__(self, storage: ChatStorage, batch_size=50, flush_interval=0.5, max_retries=5, backoff=0.5):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.failed_rows = 0
+        self.failed_by_user = collections.Counter()
+        self.last_error = None
+        self.last_failed_at = None
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="chat-history-writer", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, row):
+        self._queue.put(row)
+
+    def flush(self, timeout=10.0):
+        """キューが空になるまで（最大 timeout 秒）待つ。すべて書き込めた場合は True を返す"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        error = None
+        for attempt in range(self.max_retries):
+            try:
+                with metrics.span("db.insert_messages", rows=len(batch)):
+                    self.storage.insert_messages(batch)
+                return
+            except Exception as e:
+                error = e
+                if not is_transient_error(e):
+                    break
+                if attempt + 1 < self.max_retries:
+                    time.sleep(self.backoff * (2 ** attempt))
+        if len(batch) > 1 and not is_transient_error(error):
+            # バッチには複数のユーザーの行が混ざるので、半分ずつに分けて原因の行以外を書き込む
+            middle = len(batch) // 2
+            self._write(batch[:middle])
+            self._write(batch[middle:])
+            return
+        self._record_failure(batch, error)
+
+    def _record_failure(self, batch, error):
+        with self._lock:
+            self.failed_rows += len(batch)
+            self.failed_by_user.update(row['user_id'] for row in batch)
+            self.last_error = error
+            self.last_failed_at = datetime.datetime.now(datetime.timezone.utc)
+        print(f"メッセージ保存エラー（{len(batch)} 件を破棄）: {error}", file=sys.stderr)
+
+    def failed_count(self, user_id):
+        """user_id のメッセージのうち、書き込めずに破棄した行の数"""
+        with self._lock:
+            return self.failed_by_user[user_id]
+
+def warn_unsaved_messages(storage: ChatStorage):
+    """現在のユーザーのメッセージに、保存できずに破棄したものが新たに出ていれば警告する"""
+    failed = get_history_writer(storage).failed_count(st.session_state.user_id)
+    if failed > st.session_state.get('unsaved_messages_seen', 0):
+        st.error(f"{failed - st.session_state.get('unsaved_messages_seen', 0)} 件のメッセージを保存できませんでした。")
+        st.session_state.unsaved_messages_seen = failed
+
+def history_write_status(storage: ChatStorage):
+    """保存できずに破棄したメッセージがあれば、管理者ダッシュボードに件数と最後のエラーを表示する"""
+    writer = get_history_writer(storage)
+    if not writer.failed_rows:
+        return
+    failed_at = writer.last_failed_at.astimezone(EXPORT_TIMEZONE).strftime('%Y-%m-%d %H:%M')
+    st.error(
+        f"保存できずに破棄したメッセージが {writer.failed_rows} 件（{len(writer.failed_by_user)} 人分）あります。"
+        f"最後のエラー（{failed_at}）: {writer.last_error}"
+    )
+
+@st.cache_resource
+def get_history_writer(_storage: ChatStorage):
+    """プロセス全体で共有する履歴書き込みスレッドを返す。終了時には残りを書き込む"""
+    writer = ChatHistoryWriter(_storage)
+    atexit.register(writer.flush)
+    return writer
+
+def add_message_to_db(storage: ChatStorage, user_id, role, content):
+    """チャット履歴を書き込みキューに追加する（保存先への書き込みはバックグラウンドで行う）"""
+    get_history_writer(storage).enqueue({
+        'user_id': user_id,
+        'role': role,
+        'content': content,
+        # バッチ内でも順序が保たれるよう、時刻はキューに入れた時点で付与する
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        # 書き込みの再試行で行が重複しないよう、保存先はこの id が既にある行を追加しない
+        'client_id': str(uuid.uuid4())
+    })
+
+# 1 回の読み込みで取得するチャット履歴の件数
+HISTORY_PAGE_SIZE = 50
+
+@metrics.timed("db.get_messages")
+def get_messages_from_db(storage: ChatStorage, user_id, limit=HISTORY_PAGE_SIZE, before=None):
+    """
+    特定のユーザーのチャット履歴を新しいものから limit 件取得する。
+    before に (timestamp, id) のカーソルを渡すと、それより古いメッセージを取得する。
+    戻り値は (古い順に並べたメッセージ, さらに古い履歴を読むためのカーソル または None)。
+    """
     try:
-        response = supabase.table('users').select('id, username').eq('is_admin', False).order('username').execute()
-        return response.data 
+        # 1 件多く取得して、さらに古い履歴があるかを判定する
+        rows = storage.get_messages(user_id, limit + 1, before)
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = (rows[-1]['timestamp'], rows[-1]['id'])
+        rows.reverse()
+        return rows, next_cursor
     except Exception as e:
-        st.error(f"ユーザー取得エラー: {e}")
-        return []
+        st.error(f"履歴取得エラー: {e}")
+        return [], None
+
+def load_older_messages(storage: ChatStorage, user_id, messages_key, cursor_key):
+    """セッションに保持している履歴の前に、さらに古い 1 ページ分を追加する"""
+    cursor = st.session_state.get(cursor_key)
+    if cursor is None:
+        return
+    older, next_cursor = get_messages_from_db(storage, user_id, before=cursor)
+    st.session_state[messages_key] = older + st.session_state[messages_key]
+    st.session_state[cursor_key] = next_cursor
+    # 前に追加した古い履歴は対話コンテキストには含めない
+    if messages_key == 'messages':
+        if 'context_summary_upto' in st.session_state:
+            st.session_state['context_summary_upto'] += len(older)
+        pending = st.session_state.get('context_summary_pending')
+        if pending is not None:
+            pending['upto'] += len(older)
+            pending['target'] += len(older)
+
+def load_older_button(storage: ChatStorage, user_id, messages_key, cursor_key, key, scope="app"):
+    """さらに古い履歴がある場合に「過去の履歴を読み込む」ボタンを表示する"""
+    if st.session_state.get(cursor_key) is None:
+        return
+    if st.button("過去の履歴を読み込む", key=key):
+        load_older_messages(storage, user_id, messages_key, cursor_key)
+        st.rerun(scope=scope)
+
+# 管理者パネルのユーザー一覧の 1 ページあたりの件数
+USER_DIRECTORY_PAGE_SIZE = 20
+
+@st.cache_data(ttl=60, show_spinner=False)
+@metrics.timed("db.user_directory")
+def get_user_directory(_storage: ChatStorage, search="", page=0, page_size=USER_DIRECTORY_PAGE_SIZE):
+    """
+    管理者以外のユーザーを検索・ページ単位で取得する。
+    メッセージ数・最終利用日時・セッション数（学習記録の件数）も同じ 1 回のクエリで取得し、
+    (ユーザーのリスト, 該当ユーザーの総数) を返す。結果は一定時間キャッシュする。
+    失敗した場合は例外をそのまま送出する（エラーの結果はキャッシュしない）。
+    """
+    return _storage.user_directory(search, page * page_size, page_size)
 
-def add_message_to_db(supabase: Client, user_id, role, content):
-    """チャット履歴を Supabase に追加する"""
+# learning_summaries テーブル: id, user_id, challenge, achievement, created_at
+# 最新 1 行の取得が索引だけで済むよう (user_id, created_at desc) に索引を張っておく
+def get_past_learning_record(storage: ChatStorage, user_id):
+    """
+    過去の学習記録（learning_summaries の最新 1 行）を取得する。
+    1 セッション中は同じ記録を使うため、ユーザーごとに session_state にキャッシュする。
+    """
+    records = st.session_state.setdefault('past_learning_records', {})
+    if user_id in records:
+        return records[user_id]
+    record = {
+        "challenge": "データなし",
+        "achievement": "データなし"
+    }
     try:
-        supabase.table('chat_history').insert({
-            'user_id': user_id,
-            'role': role,
-            'content': content
-        }).execute()
+        with metrics.span("db.latest_learning_summary"):
+            row = storage.latest_learning_summary(user_id)
+        if row:
+            record = {
+                "challenge": row['challenge'] or "データなし",
+                "achievement": row['achievement'] or "データなし"
+            }
     except Exception as e:
-        st.error(f"メッセージ保存エラー: {e}")
+        print(f"学習記録の取得エラー: {e}", file=sys.stderr)
+    records[user_id] = record
+    return record
+
+LEARNING_SUMMARY_PROMPT = """
+以下は、学習者とコーチングチャットボットの今回の対話です。
+次回の対話で「前回の主要な課題」と「前回達成したこと」として参照できるよう、それぞれ1〜2文の日本語で抽出してください。
+出力は {{"challenge": "...", "achievement": "..."}} の形式の JSON のみとしてください。
+
+---
+{transcript}
+---
+"""
 
-def get_messages_from_db(supabase: Client, user_id):
-    """特定のユーザーのチャット履歴を取得する"""
+def format_transcript(messages):
+    """対話を「ユーザー: …」「チャットボット: …」の行に整形する（モデルへのプロンプト用）"""
+    return "\n".join(
+        f"{'ユーザー' if m['role'] == 'user' else 'チャットボット'}: {m['content']}" for m in messages
+    )
+
+def save_learning_summary(storage: ChatStorage, dispatcher, model_pool, user_id, messages):
+    """今回の対話から課題と達成したことをモデルで抽出し、learning_summaries に 1 行保存する"""
+    transcript = format_transcript(messages)
     try:
-        response = supabase.table('chat_history').select('role, content').eq('user_id', user_id).order('timestamp', desc=False).execute()
-        return response.data
+        model = model_pool.get_model(generation_config={"response_mime_type": "application/json"})
+
+        def generate():
+            with metrics.span("gemini.generate", purpose="learning_summary"):
+                return model.generate_content(LEARNING_SUMMARY_PROMPT.format(transcript=transcript))
+
+        response = dispatcher.call(user_id, generate)
+        summary = json.loads(response.text)
+        with metrics.span("db.insert_learning_summary"):
+            storage.insert_learning_summary(user_id, summary.get('challenge'), summary.get('achievement'))
     except Exception as e:
-        st.error(f"履歴取得エラー: {e}")
-        return []
+        print(f"学習記録の保存エラー: {e}", file=sys.stderr)
+
+@st.cache_resource
+def get_summary_executor():
+    """学習記録と対話の要約の作成をバックグラウンドで行うスレッドプール"""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
 
-def get_past_learning_record(supabase: Client, user_id):
+def schedule_learning_summary(storage: ChatStorage):
     """
-    過去の学習記録を取得する。
-    ※現在は将来のためのプレースホルダーとして「データなし」を返します。
-    将来的に、DBから過去の要約データを取得するロジックをここに実装します。
+    今回のセッションの対話から学習記録を作成する（1 セッションにつき 1 回だけ）。
+    学習者の発言がない（開始時の応答だけの）セッションでは作成しない。
+    モデル呼び出しと保存はバックグラウンドで行い、画面の応答を待たせない。
     """
-    return {
-        "challenge": "データなし",
-        "achievement": "データなし"
+    count = st.session_state.get('session_message_count', 0)
+    if count == 0 or st.session_state.get('learning_summary_saved', False):
+        return
+    session_messages = list(st.session_state.messages[-count:])
+    if not any(m['role'] == 'user' for m in session_messages):
+        return
+    st.session_state.learning_summary_saved = True
+    get_summary_executor().submit(
+        save_learning_summary, storage, get_llm_dispatcher(), get_model_pool(), st.session_state.user_id, session_messages
+    )
+
+def append_session_message(storage: ChatStorage, role, content):
+    """現在のユーザーの対話にメッセージを追加し、保存キューに入れる"""
+    st.session_state.messages.append({"role": role, "content": content})
+    st.session_state.session_message_count = st.session_state.get('session_message_count', 0) + 1
+    add_message_to_db(storage, st.session_state.user_id, role, content)
+
+# --- 学習日記の取り込み ---
+
+DOCX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+INITIAL_PROMPT = """
+あなたは今、システムプロンプト（役割定義）に従い、指導教員/コーチとして振る舞っています。
+学習者（ユーザー）が、以下の学習日記（ドキュメント）をアップロードしました。
+このドキュメントの内容を解釈し、システムプロンプトの「ステップ1」に従って、最初の応答（Botラリー1）を生成してください。
+ワンパターンな質問ではなく、日記の内容に具体的に言及し、回答しやすい具体的な問いかけを心がけてください。
+
+---
+学習日記（ドキュメント）:
+{document_content}
+---
+
+あなたの最初の応答を開始してください：
+"""
+
+def iter_docx_text(container):
+    """
+    段落・表を文書内の順番どおりにたどり、1 行ずつテキストを返す。
+    表は 1 行を「 | 」区切りの 1 行にし、結合セルは 1 回だけ出力する（横方向の結合は 1 つのセル、
+    縦方向の結合は先頭の行のセルとして扱い、続きの行では出力しない）。セル内の表もたどる。
+    """
+    import docx.table
+    for block in container.iter_inner_content():
+        if isinstance(block, docx.table.Table):
+            for tr in block._tbl.tr_lst:
+                cells = []
+                for tc in tr.tc_lst:
+                    if tc.vMerge == 'continue':
+                        continue
+                    cell = docx.table._Cell(tc, block)
+                    cells.append(" ".join(text for text in iter_docx_text(cell) if text).strip())
+                if any(cells):
+                    yield " | ".join(cells)
+        else:
+            yield block.text
+
+def extract_docx_text(file_bytes):
+    """Word ファイルのヘッダー・本文の段落・表をまとめてテキストにする"""
+    import docx
+    document = docx.Document(io.BytesIO(file_bytes))
+    lines = []
+    for section in document.sections:
+        # 前のセクションと同じヘッダーは繰り返さない
+        if not section.header.is_linked_to_previous:
+            lines.extend(iter_docx_text(section.header))
+    lines.extend(iter_docx_text(document))
+    return "\n".join(lines)
+
+@st.cache_data(max_entries=256, show_spinner=False)
+@metrics.timed("docx.extract")
+def extract_document_text(digest, _file_bytes, file_type):
+    """アップロードされたファイルのテキストを、ファイル内容の SHA-256 をキーにキャッシュして返す"""
+    if file_type == 'text/plain':
+        return _file_bytes.decode('utf-8')
+    if file_type == DOCX_MIME_TYPE:
+        return extract_docx_text(_file_bytes)
+    raise ValueError(f"対応していないファイル形式です: {file_type}")
+
+# 学習日記ごとの最初の応答を覚えておく件数
+OPENING_RESPONSE_CACHE_SIZE = 256
+
+@st.cache_resource
+def get_opening_response_cache():
+    """プロセス全体で共有する、最初の応答のキャッシュ（(ファイル内容の SHA-256, システムプロンプト) がキー）"""
+    return collections.OrderedDict(), threading.Lock()
+
+def generate_opening_response(digest, system_prompt, document_content, user_key=None, on_wait=None):
+    """
+    学習日記に対する最初の応答を生成する。
+    ファイル内容の SHA-256 とシステムプロンプトをキーにキャッシュし、同じ日記の再アップロードではモデルを呼ばない。
+    モデルの呼び出しは順番待ちの窓口（get_llm_dispatcher）を通し、待っている間は on_wait(前に並んでいる数) を呼ぶ。
+    on_wait で関数の外の表示を更新できるよう、st.cache_data ではなくプロセス内の辞書にキャッシュする。
+    """
+    responses, lock = get_opening_response_cache()
+    key = (digest, system_prompt)
+    with lock:
+        if key in responses:
+            responses.move_to_end(key)
+            return responses[key]
+
+    model = get_model_pool().get_model(system_instruction=system_prompt)
+
+    def generate():
+        with metrics.span("gemini.generate", purpose="opening"):
+            return model.generate_content(INITIAL_PROMPT.format(document_content=document_content))
+
+    response = get_llm_dispatcher().call(user_key, generate, on_wait=on_wait)
+    with lock:
+        responses[key] = response.text
+        while len(responses) > OPENING_RESPONSE_CACHE_SIZE:
+            responses.popitem(last=False)
+    return response.text
+
+# --- Gemini 設定 ---
+
+@st.cache_resource
+def configure_genai(api_key):
+    """google.generativeai を読み込み、Gemini API キーをプロセスで一度だけ設定して返す"""
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    return genai
+
+def load_genai():
+    """
+    Gemini のモデルを作る直前に呼ぶ。
+    google.generativeai の読み込みには時間とメモリがかかるので、起動時ではなく最初に Gemini を使うときに行う。
+    """
+    return configure_genai(st.secrets["google_api_key"])
+
+@st.cache_resource
+def get_llm_dispatcher():
+    """
+    プロセス全体で共有する Gemini 呼び出しの順番待ちの窓口。
+    同時実行数は Streamlit Secrets の gemini_max_concurrency で変更できる。
+    """
+    return LLMDispatcher(max_concurrency=st.secrets.get("gemini_max_concurrency", DEFAULT_MAX_CONCURRENCY))
+
+def queue_position_notifier(placeholder):
+    """順番待ちの間、前に並んでいる件数を placeholder に表示する on_wait 関数を返す"""
+    def show_queue_position(position):
+        placeholder.info(f"混み合っています。順番に応答しますので、少しお待ちください（あなたの前に {position} 件）。")
+    return show_queue_position
+
+# --- システムプロンプトとモデルの再利用 ---
+
+# ★★★ ベースシステムプロンプト（目標立ち返り＆URL誘導を追加） ★★★
+BASE_SYSTEM_PROMPT = """
+あなたはユーザーがアップロードしたファイル内の「学習目標」に精通した優秀な指導教員であり、独学する成人学習者の自己成長を支援する親しみやすいコーチングチャットボットです。
+
+### 0. リアルタイム・コンテキスト（動的注入データ）
+以下の情報はシステムによって自動更新されます。これらに基づいて回答を調整してください。
+
+<past_learning_record>
+・前回の主要な課題: {past_challenge}
+・前回達成したこと: {past_achievement}
+</past_learning_record>
+
+<user_status>
+・直近の入力の長さ: {input_length_status}
+・疲労フラグ: {fatigue_flag}
+</user_status>
+
+---
+
+### 1. 最重要ルール：フェーズ制と疲労への配慮
+対話履歴の往復回数を確認し、以下のフェーズを厳密に守ってください。ただし、<user_status>の「疲労フラグ」が ON の場合は、即座にフェーズ3（終了）へ誘導してください。
+
+* **フェーズ1（1〜3往復目）：徹底的な内省（Step 1）**
+    - 目的：安易な解決策を出さず、ユーザーの思考を深く掘り下げる。
+    - 義務：3往復目の最後に「現在ステップ1/3が終了です。次は成長の振り返りですが、続けても大丈夫ですか？」と進捗を確認すること。
+
+* **フェーズ2（4〜6往復目）：視点の転換と過去比較（Step 2）**
+    - 目的：過去の自分（<past_learning_record>）と比較し、成長を実感させる。
+    - 義務：必ず「前回の課題であった〇〇が、今回は△△になっていますね」と言及すること。
+
+* **フェーズ3（7往復目以降、または終了希望時）：目標の再確認とクロージング（Step 3）**
+    - 目的：ドキュメント内の「学習目標」が現在も適切か確認し、次回の行動（Volition）を決める。
+    - 義務：目標の調整が必要な場合は、指定の目標設定アプリ（URL）を案内すること。
+
+---
+
+### 2. 対話の進行プロセス（Step by Step）
+
+#### 【ステップ1：深掘り】
+ユーザーの回答に対し、「なぜ？」「具体的には？」と**最低2回以上**質問を重ねてください。
+※疲労フラグがON、または入力が極端に短い場合は、深掘りを中止して労りの言葉をかけてください。
+
+#### 【ステップ2：過去比較による自信の醸成】
+`<past_learning_record>` を参照し、以下の構成で話してください。
+1. **過去の引用:** 「前回は[課題]と仰っていましたが、」
+2. **成長の承認:** 「今回は[今回の気づき]ができていますね！素晴らしい進歩です。」
+※データが「データなし」の場合は、本日の対話の冒頭の発言と比較してください。
+
+#### 【ステップ3：目標の再確認とクロージング】
+次回の具体的な行動計画を決める前に、**アップロードされたドキュメント内の「学習目標」に言及し**、以下の対応を行ってください。
+1. **目標の確認:** 「現在の目標（〇〇）に対して、このまま進めて良いか、それとも目標自体の調整や練り直しが必要か」をユーザーに確認する。
+2. **URLの案内:** もしユーザーが「目標の調整や練り直しが必要だ」と判断した場合は、「では、一度目標設定をリセットしましょう」と伝え、**必ず以下のURLを案内**して再設定を勧めてください。
+   - 目標設定用チャットボット： https://learninggoal-chatbot.streamlit.app/
+3. **クロージング:** 最後に、次回のアクション（学習の継続、または目標の再設定）を宣言させ、「次回も楽しみにしています！」とポジティブに終了します。
+
+---
+
+### 3. 禁止事項・スタンス
+* 直接的なアドバイスや正解の提示は行わない。
+* 専門的な質問には「一緒に調べましょう」または「検索を促す」に留める。
+* 常にARCS-Vモデルを意識し、自信（C）と意志（V）を高める声掛けを徹底する。
+"""
+
+
+class PromptTemplate:
+    """str.format 形式のテンプレートを一度だけ解析しておき、差し込みは文字列の連結だけで行う"""
+
+    def __init__(self, template):
+        self._parts = list(string.Formatter().parse(template))
+
+    def render(self, **values):
+        rendered = []
+        for literal, field, _, _ in self._parts:
+            rendered.append(literal)
+            if field is not None:
+                rendered.append(str(values[field]))
+        return "".join(rendered)
+
+SYSTEM_PROMPT_TEMPLATE = PromptTemplate(BASE_SYSTEM_PROMPT)
+
+def render_system_prompt(past_challenge, past_achievement, input_length_status, fatigue_flag):
+    """ベースシステムプロンプトに動的な値を差し込む"""
+    return SYSTEM_PROMPT_TEMPLATE.render(
+        past_challenge=past_challenge,
+        past_achievement=past_achievement,
+        input_length_status=input_length_status,
+        fatigue_flag=fatigue_flag
+    )
+
+# 使い回す GenerativeModel の上限数
+MODEL_POOL_SIZE = 32
+
+class GenerativeModelPool:
+    """
+    GenerativeModel をキーごとに使い回す、上限付きのプール。
+    上限を超えた場合は、最も長く使われていないものから捨てる。
+    """
+
+    def __init__(self, max_size=MODEL_POOL_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._models = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, key, factory):
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return self._models[key]
+            self.misses += 1
+        value = factory()
+        with self._lock:
+            self._models[key] = value
+            self._models.move_to_end(key)
+            while len(self._models) > self.max_size:
+                self._models.popitem(last=False)
+        return value
+
+    def get_model(self, system_instruction=None, generation_config=None, model_name='gemini-2.5-flash'):
+        """システムプロンプトと生成設定が同じモデルを使い回す"""
+        config_key = json.dumps(generation_config, sort_keys=True) if generation_config else None
+        key = ('model', model_name, system_instruction, config_key)
+
+        def create():
+            genai = load_genai()
+            with metrics.span("gemini.model_init"):
+                return genai.GenerativeModel(
+                    model_name, system_instruction=system_instruction, generation_config=generation_config
+                )
+        return self._get_or_create(key, create)
+
+    def get_chat_model(self, past_challenge, past_achievement, input_length_status, fatigue_flag):
+        """
+        チャット用の (システムプロンプト, モデル) を、プロンプトに差し込む 4 つの値だけをキーにして返す。
+        プロンプトの組み立てもキャッシュにない場合だけ行う。
+        """
+        key = ('chat', past_challenge, past_achievement, input_length_status, fatigue_flag)
+
+        def create():
+            system_prompt = render_system_prompt(past_challenge, past_achievement, input_length_status, fatigue_flag)
+            return system_prompt, self.get_model(system_instruction=system_prompt)
+        return self._get_or_create(key, create)
+
+@st.cache_resource
+def get_model_pool():
+    """プロセス全体で共有する GenerativeModel のプール"""
+    return GenerativeModelPool()
+
+# --- 対話コンテキスト管理 ---
+
+# Gemini に送る 1 リクエストあたりのトークン予算（システムプロンプト・日記・要約・直近の発言の合計）
+CONTEXT_TOKEN_BUDGET = 16000
+# 要約せずにそのまま送る直近のメッセージ数
+CONTEXT_RECENT_MESSAGES = 6
+# 要約に割り当てるトークン数の目安
+SUMMARY_TOKEN_BUDGET = 800
+# 直近より古い未要約のメッセージがこの数に達したら、まとめて要約に畳み込む
+CONTEXT_SUMMARY_CHUNK = 20
+# いずれも Streamlit Secrets の context_token_budget / context_recent_messages /
+# summary_token_budget / context_summary_chunk で変更できる
+
+SUMMARY_PROMPT = """
+以下は、学習者とコーチングチャットボットの対話の「これまでの要約」と「新しく要約に含める発言」です。
+両方を統合し、学習者の課題・気づき・感情・決めた行動が分かるように、{max_chars}文字以内の日本語で要約し直してください。
+要約本文のみを出力してください。
+
+これまでの要約:
+{summary}
+
+新しく要約に含める発言:
+{transcript}
+"""
+
+def estimate_tokens(text):
+    """トークン数を概算する（日本語はおおむね 1 文字 1 トークン、英数字は 4 文字で 1 トークン）"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+def summarize_messages(dispatcher, model_pool, user_key, summary, messages, max_chars):
+    """既存の要約に messages の内容を畳み込んだ新しい要約を生成する（バックグラウンドのスレッドからも呼ぶ）"""
+    transcript = format_transcript(messages)
+    prompt = SUMMARY_PROMPT.format(
+        max_chars=max_chars,
+        summary=summary or "（なし）",
+        transcript=transcript
+    )
+    model = model_pool.get_model()
+
+    def generate():
+        with metrics.span("gemini.generate", purpose="context_summary"):
+            return model.generate_content(prompt)
+
+    response = dispatcher.call(user_key, generate)
+    return response.text.strip()
+
+def apply_pending_summary(wait=False):
+    """
+    バックグラウンドで作成中の要約が終わっていれば、context_summary / context_summary_upto に反映する。
+    wait が True の場合は終わるまで待つ。
+    """
+    pending = st.session_state.get('context_summary_pending')
+    if pending is None or not (wait or pending['future'].done()):
+        return
+    del st.session_state['context_summary_pending']
+    try:
+        summary = pending['future'].result()
+    except Exception as e:
+        print(f"要約の生成に失敗しました: {e}", file=sys.stderr)
+        return
+    # 作成を始めた後に別の要約が反映されていた場合は捨てる
+    if st.session_state.get('context_summary_upto', 0) == pending['upto']:
+        st.session_state.context_summary = summary
+        st.session_state.context_summary_upto = pending['target']
+
+def schedule_context_summary(messages):
+    """
+    直近より古い未要約のメッセージが context_summary_chunk 件以上たまっていたら、
+    応答の後にバックグラウンドで要約に畳み込む。結果は次のターンの build_chat_context で反映する。
+    """
+    if 'context_summary_pending' in st.session_state:
+        return
+    upto = st.session_state.get('context_summary_upto', 0)
+    target = len(messages) - st.secrets.get("context_recent_messages", CONTEXT_RECENT_MESSAGES)
+    if target - upto < st.secrets.get("context_summary_chunk", CONTEXT_SUMMARY_CHUNK):
+        return
+    future = get_summary_executor().submit(
+        summarize_messages,
+        get_llm_dispatcher(),
+        get_model_pool(),
+        st.session_state.get('user_id'),
+        st.session_state.get('context_summary', ""),
+        list(messages[upto:target]),
+        st.secrets.get("summary_token_budget", SUMMARY_TOKEN_BUDGET),
+    )
+    st.session_state.context_summary_pending = {'future': future, 'upto': upto, 'target': target}
+
+def build_chat_context(system_prompt, document_content, messages, document_cached=False, user_status=None):
+    """
+    Gemini に送る history を組み立て、(history, 推定入力トークン数) を返す。
+    要約していないメッセージはそのまま送り、要約への畳み込みは通常は応答の後にまとめて行う（schedule_context_summary）。
+    そのまま送るとトークン予算を超える場合だけ、この場で直近以外を要約に畳み込む。
+    要約に含めたメッセージ数は context_summary_upto に保持する。
+    document_cached が True の場合、学習日記はキャッシュ済みとみなして history には含めず、
+    user_status（動的な <user_status>）と要約だけを先頭に付ける。
+    """
+    token_budget = st.secrets.get("context_token_budget", CONTEXT_TOKEN_BUDGET)
+    recent_messages = st.secrets.get("context_recent_messages", CONTEXT_RECENT_MESSAGES)
+    summary_budget = st.secrets.get("summary_token_budget", SUMMARY_TOKEN_BUDGET)
+
+    apply_pending_summary()
+    fixed_tokens = estimate_tokens(system_prompt) + estimate_tokens(document_content) + summary_budget
+    message_tokens = [estimate_tokens(m['content']) for m in messages]
+
+    if fixed_tokens + sum(message_tokens[st.session_state.get('context_summary_upto', 0):]) > token_budget:
+        apply_pending_summary(wait=True)
+    summary = st.session_state.get('context_summary', "")
+    upto = st.session_state.get('context_summary_upto', 0)
+
+    if fixed_tokens + sum(message_tokens[upto:]) > token_budget:
+        # 予算に収まる範囲で、そのまま送る直近のメッセージ数を決める（最低でも最新の往復は残す）
+        keep = min(recent_messages, len(messages))
+        while keep > 2 and fixed_tokens + sum(message_tokens[len(messages) - keep:]) > token_budget:
+            keep -= 1
+        target = len(messages) - keep
+        if target > upto:
+            try:
+                summary = summarize_messages(
+                    get_llm_dispatcher(), get_model_pool(), st.session_state.get('user_id'),
+                    summary, messages[upto:target], summary_budget
+                )
+                upto = target
+                st.session_state.context_summary = summary
+                st.session_state.context_summary_upto = upto
+            except Exception as e:
+                # 要約に失敗した場合は、未要約のメッセージをそのまま送る
+                print(f"要約の生成に失敗しました: {e}", file=sys.stderr)
+
+    if document_cached:
+        context_parts = [part for part in (user_status, summary and f"参考：これまでの対話の要約:\n{summary}") if part]
+        document_context = "\n\n".join(context_parts)
+        ack = "（承知しました。現在の状況と対話の要約を参照します。）"
+    else:
+        document_context = f"参考：ユーザーの学習日記（ドキュメント）:\n{document_content or 'ドキュメントなし'}"
+        if summary:
+            document_context += f"\n\n参考：これまでの対話の要約:\n{summary}"
+        ack = "（承知しました。学習日記を再度参照します。）"
+    history = []
+    if document_context:
+        history.append({'role': 'user', 'parts': [document_context]})
+        history.append({'role': 'model', 'parts': [ack]})
+    for msg in messages[upto:]:
+        role = "user" if msg["role"] == "user" else "model"
+        history.append({'role': role, 'parts': [msg["content"]]})
+
+    estimated = (
+        estimate_tokens(system_prompt) + estimate_tokens(document_context) + sum(message_tokens[upto:])
+    )
+    if document_cached:
+        estimated += estimate_tokens(document_content)
+    return history, estimated
+
+def reset_chat_context():
+    """対話の要約状態を破棄する（表示するユーザーが切り替わったときなど）"""
+    for key in ('context_summary', 'context_summary_upto', 'context_summary_pending'):
+        if key in st.session_state:
+            del st.session_state[key]
+
+# --- Gemini コンテキストキャッシュ ---
+
+# キャッシュの有効期間（秒）
+CONTEXT_CACHE_TTL_SECONDS = 3600
+# 有効期限がこれより近いキャッシュは使わずに作り直す（秒）
+CONTEXT_CACHE_EXPIRY_MARGIN_SECONDS = 60
+# プロセス内で覚えておくキャッシュの数（古く使われていないものから捨てる）
+CONTEXT_CACHE_MAX_ENTRIES = 256
+# キャッシュ利用時にシステムプロンプトの <user_status> 欄に入れる文言
+USER_STATUS_PER_TURN = "（各ターンの最初に送られる <user_status> を参照）"
+
+def format_user_status(input_length_status, fatigue_flag):
+    """ターンごとに送る <user_status> ブロックを作る"""
+    return (
+        "<user_status>\n"
+        f"・直近の入力の長さ: {input_length_status}\n"
+        f"・疲労フラグ: {fatigue_flag}\n"
+        "</user_status>"
+    )
+
+class GeminiCachingClient:
+    """google.generativeai の CachedContent を使うキャッシュクライアント"""
+
+    def create(self, model_name, system_instruction, contents, ttl_seconds):
+        load_genai()
+        from google.generativeai import caching
+        return caching.CachedContent.create(
+            model=model_name,
+            system_instruction=system_instruction,
+            contents=contents,
+            ttl=datetime.timedelta(seconds=ttl_seconds),
+        )
+
+    def model_from_cache(self, cached_content):
+        return load_genai().GenerativeModel.from_cached_content(cached_content=cached_content)
+
+def is_cache_too_small_error(error):
+    """内容のトークン数がキャッシュできる下限に満たないことによるエラーかどうか"""
+    message = str(error)
+    return "too small" in message or "min_total_token_count" in message
+
+class ContextCacheRegistry:
+    """
+    システムプロンプトと学習日記からなる固定の前置きを、内容のハッシュをキーにして
+    一度だけキャッシュ登録し、以降の generate_content で再利用する。
+    登録は直近に使った max_entries 件だけを覚え、有効期限を過ぎたものは捨てる。
+    client は GeminiCachingClient と同じ create / model_from_cache を持つオブジェクト
+    （オフライン検証用には fakes.FakeCachingClient）を渡す。
+    """
+
+    def __init__(self, client, model_name='models/gemini-2.5-flash', ttl_seconds=CONTEXT_CACHE_TTL_SECONDS, max_entries=CONTEXT_CACHE_MAX_ENTRIES):
+        self.client = client
+        self.model_name = model_name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(system_instruction, document_content):
+        digest = hashlib.sha256()
+        digest.update(system_instruction.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update((document_content or "").encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_model(self, system_instruction, document_content):
+        """
+        キャッシュ済みのコンテキストを使うモデルを返す。
+        キャッシュを作れない内容（トークン数が下限未満など）の場合は None を返す。
+        """
+        key = self.cache_key(system_instruction, document_content)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] - CONTEXT_CACHE_EXPIRY_MARGIN_SECONDS > now:
+                self._entries.move_to_end(key)
+                cached_content = entry[0]
+                if cached_content is None:
+                    return None
+                self.hits += 1
+                return self.client.model_from_cache(cached_content)
+            self._entries.pop(key, None)
+            self.misses += 1
+
+        contents = [{'role': 'user', 'parts': [f"参考：ユーザーの学習日記（ドキュメント）:\n{document_content}"]}]
+        try:
+            cached_content = self.client.create(self.model_name, system_instruction, contents, self.ttl_seconds)
+        except Exception as e:
+            print(f"コンテキストキャッシュの作成に失敗しました: {e}", file=sys.stderr)
+            # 内容が短すぎてキャッシュできない場合だけ、有効期間中は再試行しない
+            # （レート制限や通信エラーは次のターンで再試行する）
+            if not is_cache_too_small_error(e):
+                return None
+            cached_content = None
+        with self._lock:
+            self._entries[key] = (cached_content, now + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            expired = [k for k, (_, expires_at) in self._entries.items() if expires_at <= now]
+            for k in expired:
+                del self._entries[k]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if cached_content is None:
+            return None
+        return self.client.model_from_cache(cached_content)
+
+@st.cache_resource
+def get_context_cache():
+    """プロセス全体で共有するコンテキストキャッシュを返す"""
+    return ContextCacheRegistry(GeminiCachingClient())
+
+# --- ストリーミング表示 ---
+
+# ストリーミング中に画面を更新する最小間隔（秒）
+STREAM_FLUSH_INTERVAL = 0.15
+# 前回の更新からこの文字数以上たまった場合は、間隔に関係なく更新する
+STREAM_FLUSH_CHARS = 400
+
+def render_stream(placeholder, response_stream, started=None, flush_interval=STREAM_FLUSH_INTERVAL, flush_chars=STREAM_FLUSH_CHARS):
+    """
+    Gemini のストリーミング応答をまとめて描画し、(全文, 計測値) を返す。
+    チャンクごとではなく、一定の時間または文字数ごとにだけ placeholder を更新する。
+    計測値は time_to_first_token（最初のチャンクまでの秒数）、total（全体の秒数）、flushes（描画回数）。
+    """
+    started = started if started is not None else time.monotonic()
+    parts = []
+    pending_chars = 0
+    last_flush = started
+    first_token_at = None
+    flushes = 0
+    for chunk in response_stream:
+        if not chunk.parts:
+            continue
+        text_part = chunk.parts[0].text
+        if first_token_at is None:
+            first_token_at = time.monotonic()
+        parts.append(text_part)
+        pending_chars += len(text_part)
+        now = time.monotonic()
+        if now - last_flush >= flush_interval or pending_chars >= flush_chars:
+            placeholder.markdown("".join(parts) + "▌")
+            last_flush = now
+            pending_chars = 0
+            flushes += 1
+    full_response = "".join(parts)
+    placeholder.markdown(full_response)
+    finished = time.monotonic()
+    stats = {
+        'time_to_first_token': (first_token_at or finished) - started,
+        'total': finished - started,
+        'flushes': flushes + 1,
     }
+    return full_response, stats
 
 # --- 管理者パネル ---
-def admin_panel(supabase: Client): 
+def return_to_admin_view(storage: ChatStorage):
+    """
+    代理ログインを終えて管理者ビューに戻る。
+    学習者として行った対話の学習記録は、切り替える前に学習者の ID で作成しておく。
+    """
+    schedule_learning_summary(storage)
+    get_history_writer(storage).flush()
+    st.session_state['user_id'] = st.session_state['admin_id']
+    st.session_state['username'] = st.session_state['admin_username']
+    st.session_state['is_admin'] = True
+    st.session_state['impersonating'] = False
+    st.session_state.session_message_count = 0
+    st.session_state.learning_summary_saved = False
+    reset_chat_context()
+    if 'viewing_messages' in st.session_state:
+        del st.session_state['viewing_messages']
+    st.rerun()
+
+def admin_panel(storage: ChatStorage): 
     st.sidebar.title("管理者パネル")
     st.sidebar.write("---")
     
     if st.session_state.get('impersonating', False):
         if st.sidebar.button("管理者ビューに戻る"):
-            st.session_state['user_id'] = st.session_state['admin_id']
-            st.session_state['username'] = st.session_state['admin_username']
-            st.session_state['is_admin'] = True
-            st.session_state['impersonating'] = False
-            if 'viewing_messages' in st.session_state:
-                del st.session_state['viewing_messages']
-            st.rerun()
+            return_to_admin_view(storage)
         st.sidebar.write("---")
 
     st.sidebar.subheader("ユーザー一覧")
-    users = get_all_users(supabase) 
+    search = st.sidebar.text_input("ユーザー名で検索", key="directory_search").strip()
+    if st.session_state.get('directory_last_search') != search:
+        st.session_state['directory_last_search'] = search
+        st.session_state['directory_page'] = 0
+    page = st.session_state.get('directory_page', 0)
+    try:
+        users, total = get_user_directory(storage, search, page)
+    except Exception as e:
+        st.sidebar.error(f"ユーザー取得エラー: {e}")
+        return
     if not users:
-        st.sidebar.info("まだ一般ユーザーは登録されていません。")
+        if search:
+            st.sidebar.info("該当するユーザーが見つかりません。")
+        else:
+            st.sidebar.info("まだ一般ユーザーは登録されていません。")
         return
 
+    page_count = (total + USER_DIRECTORY_PAGE_SIZE - 1) // USER_DIRECTORY_PAGE_SIZE
+    st.sidebar.caption(f"{total} 人中 {page * USER_DIRECTORY_PAGE_SIZE + 1}〜{page * USER_DIRECTORY_PAGE_SIZE + len(users)} 人目")
+    prev_col, next_col = st.sidebar.columns(2)
+    if prev_col.button("前へ", disabled=page == 0, key="directory_prev"):
+        st.session_state['directory_page'] = page - 1
+        st.rerun()
+    if next_col.button("次へ", disabled=page + 1 >= page_count, key="directory_next"):
+        st.session_state['directory_page'] = page + 1
+        st.rerun()
+
     for user in users:
         with st.sidebar.expander(f"ユーザー: {user['username']}"):
+            last_activity = format_timestamp(user['last_activity']) if user['last_activity'] else "なし"
+            st.caption(
+                f"メッセージ数: {user['message_count']} / 最終利用: {last_activity} / セッション数: {user['session_count']}"
+            )
             if st.button("履歴を閲覧", key=f"view_{user['id']}"):
-                messages = get_messages_from_db(supabase, user['id']) 
+                get_history_writer(storage).flush()
+                messages, cursor = get_messages_from_db(storage, user['id'])
                 st.session_state['viewing_messages'] = messages
+                st.session_state['viewing_cursor'] = cursor
+                st.session_state['viewing_user_id'] = user['id']
                 st.session_state['viewing_username'] = user['username']
                 if 'impersonating' in st.session_state:
                     st.session_state['impersonating'] = False
 
             if st.button("このユーザーとしてログイン", key=f"login_as_{user['id']}"):
+                get_history_writer(storage).flush()
                 st.session_state['impersonating'] = True
                 st.session_state['admin_id'] = st.session_state['user_id']
                 st.session_state['admin_username'] = st.session_state['username']
                 st.session_state['user_id'] = user['id']
                 st.session_state['username'] = user['username']
                 st.session_state['is_admin'] = False
-                st.session_state.messages = get_messages_from_db(supabase, user['id']) 
+                st.session_state.messages, st.session_state.history_cursor = get_messages_from_db(storage, user['id'])
+                st.session_state.session_message_count = 0
+                st.session_state.learning_summary_saved = False
+                reset_chat_context()
                 if 'viewing_messages' in st.session_state:
                     del st.session_state['viewing_messages']
                 st.rerun()
 
+# --- チャット画面 ---
+
+def render_messages(messages):
+    """メッセージを順にチャット形式で表示する"""
+    for message in messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+def chat_history_pane(storage: ChatStorage):
+    """
+    読み込み済みの履歴を表示する。フルリラン時にだけ描画され、チャットの各ターンでは再描画しない。
+    ここで表示した件数を history_rendered_upto に記録し、以降のメッセージは chat_turn_pane が表示する。
+    """
+    load_older_button(storage, st.session_state.user_id, 'messages', 'history_cursor', "load_older_messages")
+    render_messages(st.session_state.messages)
+    st.session_state.history_rendered_upto = len(st.session_state.messages)
+
+@st.fragment
+@metrics.timed("rerun.chat_turn")
+def chat_turn_pane(storage: ChatStorage):
+    """
+    前回のフルリラン以降に追加されたメッセージと入力欄を表示し、1 ターン分の応答を生成する。
+    フラグメントとして実行されるため、チャットの各ターンで再実行されるのはこの部分だけになる。
+    """
+    render_messages(st.session_state.messages[st.session_state.history_rendered_upto:])
+    warn_unsaved_messages(storage)
+
+    if prompt := st.chat_input("ドキュメントについて質問してください"):
+        append_session_message(storage, "user", prompt)
+        with st.chat_message("user"):
+            st.markdown(prompt)
+
+        try:
+            input_len = len(prompt)
+            input_length_status = "短い" if input_len < 10 else "適切"
+
+            # 疲労は今回のセッションの発言だけで判定する（読み込んだ過去の履歴は数えない）
+            session_turn_count = st.session_state.get('session_message_count', 0)
+            fatigue_flag = "ON" if (input_len < 10 and session_turn_count >= 6) else "OFF"
+
+            p_data = get_past_learning_record(storage, st.session_state.user_id)
+            document_content = st.session_state.get('document_content')
+
+            model = None
+            if st.secrets.get("gemini_context_cache", False) and document_content:
+                # 固定部分（システムプロンプトと学習日記）はキャッシュし、<user_status> はターンごとに送る
+                dynamic_system_prompt = render_system_prompt(
+                    p_data['challenge'], p_data['achievement'], USER_STATUS_PER_TURN, USER_STATUS_PER_TURN
+                )
+                model = get_context_cache().get_model(dynamic_system_prompt, document_content)
+
+            if model is not None:
+                history, estimated_tokens = build_chat_context(
+                    dynamic_system_prompt,
+                    document_content,
+                    st.session_state.messages,
+                    document_cached=True,
+                    user_status=format_user_status(input_length_status, fatigue_flag)
+                )
+            else:
+                dynamic_system_prompt, model = get_model_pool().get_chat_model(
+                    p_data['challenge'], p_data['achievement'], input_length_status, fatigue_flag
+                )
+                history, estimated_tokens = build_chat_context(
+                    dynamic_system_prompt,
+                    document_content,
+                    st.session_state.messages
+                )
+
+            with st.chat_message("assistant"):
+                queue_placeholder = st.empty()
+                message_placeholder = st.empty()
+
+            def stream_reply():
+                stream_started = time.monotonic()
+                response_stream = model.generate_content(history, stream=True)
+                full_response, stream_stats = render_stream(
+                    message_placeholder,
+                    response_stream,
+                    started=stream_started,
+                    flush_interval=st.secrets.get("stream_flush_interval", STREAM_FLUSH_INTERVAL),
+                    flush_chars=st.secrets.get("stream_flush_chars", STREAM_FLUSH_CHARS)
+                )
+                return response_stream, full_response, stream_stats
+
+            try:
+                response_stream, full_response, stream_stats = get_llm_dispatcher().call(
+                    st.session_state.user_id, stream_reply, on_wait=queue_position_notifier(queue_placeholder)
+                )
+            finally:
+                queue_placeholder.empty()
+            st.session_state.last_stream_stats = stream_stats
+            metrics.recorder.record("gemini.ttft", stream_stats['time_to_first_token'])
+            metrics.recorder.record("gemini.stream_total", stream_stats['total'], flushes=stream_stats['flushes'])
+
+            # 入力トークン数（実際の値と build_chat_context の推定値）は管理者ダッシュボードで確認する
+            usage = getattr(response_stream, 'usage_metadata', None)
+            prompt_tokens = getattr(usage, 'prompt_token_count', None)
+            if prompt_tokens is not None:
+                metrics.recorder.observe("gemini.prompt_tokens", prompt_tokens, "tokens")
+            metrics.recorder.observe(
+                "context.estimated_tokens", estimated_tokens, "tokens",
+                summarized=st.session_state.get('context_summary_upto', 0)
+            )
+
+            append_session_message(storage, "assistant", full_response)
+            schedule_context_summary(st.session_state.messages)
+
+            # フェーズ3（7往復目以降、または疲労フラグ ON）に入ったら今回の学習記録を作成する
+            session_messages = st.session_state.messages[-st.session_state.session_message_count:]
+            session_turns = sum(1 for m in session_messages if m["role"] == "user")
+            if session_turns >= 7 or fatigue_flag == "ON":
+                schedule_learning_summary(storage)
+
+        except Exception as e:
+            # エラーの文言は応答として履歴に保存しない
+            if is_rate_limit_error(e):
+                st.error("現在アクセスが集中しています。少し時間をおいてから、もう一度送信してください。")
+            else:
+                st.error("エラーが発生しました。詳細はコンソールを確認してください。")
+            print(f"エラーの詳細: {e}", file=sys.stderr)
+
+class ConversationExport:
+    """
+    対話履歴の Word / CSV エクスポート。
+    履歴はセッションに保持している直近の分ではなく保存先からページ単位で読み、
+    前回作成した時点より新しいメッセージだけを文書と CSV に追記する。ファイルの中身は追記があったときだけ作り直す。
+    """
+
+    def __init__(self, user_id, username):
+        import docx
+        self.user_id = user_id
+        self.username = username
+        self.count = 0
+        # 最後に取り込んだメッセージの (timestamp, id)
+        self.last = None
+        self._document = docx.Document()
+        self._document.add_heading(f'{username}さんの振り返り', 0)
+        self._csv_buffer = io.StringIO()
+        self._csv_writer = csv.writer(self._csv_buffer, lineterminator='\n')
+        self._csv_writer.writerow(['role', 'content'])
+        self._csv_chunks = []
+        self._flush_csv()
+        self._docx_cache = None
+        self._csv_cache = None
+
+    def update(self, storage: ChatStorage):
+        """保存先から、まだ取り込んでいないメッセージを古い順に追記する"""
+        with metrics.span("export.update"):
+            for rows in bulk_export.iter_message_pages(storage, after=self.last, user_ids=[self.user_id]):
+                self._append(rows)
+
+    def _append(self, messages):
+        for message in messages:
+            role_jp = "ユーザー" if message["role"] == "user" else "チャットボット"
+            self._document.add_paragraph(f"{role_jp}: {message['content']}")
+            self._csv_writer.writerow([message['role'], message['content']])
+        self._flush_csv()
+        self.count += len(messages)
+        self.last = (messages[-1]['timestamp'], messages[-1]['id'])
+        self._docx_cache = None
+        self._csv_cache = None
+
+    def _flush_csv(self):
+        """CSV バッファの内容をエンコード済みのチャンクとして確定させる"""
+        self._csv_chunks.append(self._csv_buffer.getvalue().encode('utf-8'))
+        self._csv_buffer.seek(0)
+        self._csv_buffer.truncate()
+
+    def docx_bytes(self):
+        if self._docx_cache is None:
+            with metrics.span("export.docx", messages=self.count):
+                doc_io = io.BytesIO()
+                self._document.save(doc_io)
+                self._docx_cache = doc_io.getvalue()
+        return self._docx_cache
+
+    def csv_bytes(self):
+        if self._csv_cache is None:
+            with metrics.span("export.csv", messages=self.count):
+                self._csv_cache = b"".join(self._csv_chunks)
+        return self._csv_cache
+
+def get_conversation_export(storage: ChatStorage, user_id, username):
+    """セッションに保持しているエクスポートを、保存先に追加された分だけ更新して返す"""
+    export = st.session_state.get('conversation_export')
+    if export is None or export.user_id != user_id:
+        export = ConversationExport(user_id, username)
+        st.session_state.conversation_export = export
+    # このプロセスでまだ保存されていないメッセージを書き込んでから読む
+    get_history_writer(storage).flush()
+    export.update(storage)
+    return export
+
+@st.fragment
+def export_panel(storage: ChatStorage):
+    """エクスポート欄。ボタンが押されたときに、その時点までに保存された全履歴からファイルを作成する"""
+    st.header("エクスポート")
+    if st.button("最新の対話履歴でエクスポートを作成"):
+        get_conversation_export(storage, st.session_state['user_id'], st.session_state['username'])
+    export = st.session_state.get('conversation_export')
+    # 作成後に別のユーザーに切り替わった場合（管理者の代理ログインなど）は表示しない
+    if export is None or export.user_id != st.session_state['user_id']:
+        return
+    st.download_button(
+        label="振り返りをWord形式でダウンロード",
+        data=export.docx_bytes(),
+        file_name=f"{st.session_state['username']}_振り返り.docx",
+        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+    )
+    if export.count:
+        st.download_button(
+            label="対話履歴をCSV形式でダウンロード",
+            data=export.csv_bytes(),
+            file_name=f"{st.session_state['username']}_対話履歴.csv",
+            mime="text/csv",
+        )
+
+@st.fragment
+def admin_history_viewer(storage: ChatStorage):
+    """管理者ダッシュボードの履歴表示。過去の履歴の読み込みはこの部分だけを再実行する"""
+    if 'viewing_messages' not in st.session_state:
+        return
+    st.header(f"ユーザー「{st.session_state['viewing_username']}」の学習履歴")
+    messages_to_display = st.session_state['viewing_messages']
+    if not messages_to_display:
+        st.write("このユーザーのチャット履歴はまだありません。")
+    else:
+        load_older_button(storage, st.session_state['viewing_user_id'], 'viewing_messages', 'viewing_cursor', "load_older_viewing", scope="fragment")
+        render_messages(messages_to_display)
+
+def cache_counters(storage: ChatStorage):
+    """プロセス内のキャッシュごとのヒット数・ミス数（プロセスの起動からの累計）"""
+    caches = [("モデルのプール", get_model_pool()), ("コンテキストキャッシュ", get_context_cache())]
+    if isinstance(storage, CachedStorage):
+        caches.insert(0, ("履歴キャッシュ", storage))
+    rows = []
+    for name, cache in caches:
+        total = cache.hits + cache.misses
+        rows.append({
+            "キャッシュ": name,
+            "ヒット": cache.hits,
+            "ミス": cache.misses,
+            "ヒット率": f"{cache.hits / total:.0%}" if total else "-",
+        })
+    return rows
+
+@st.fragment
+def hot_path_dashboard(storage: ChatStorage):
+    """
+    ホットパスの処理時間とトークン数（直近のパーセンタイル）、Gemini 呼び出しの状況、キャッシュのヒット率を表示し、
+    計測データを JSON Lines で書き出せるようにする
+    """
+    with st.expander("ホットパス計測"):
+        dispatcher = get_llm_dispatcher()
+        st.caption(
+            f"Gemini 呼び出し: 実行中 {dispatcher.active} / 上限 {dispatcher.max_concurrency}、"
+            f"レート制限による再試行 {dispatcher.rate_limited} 回（プロセスの起動からの累計）"
+        )
+        st.table(cache_counters(storage))
+        rows = metrics.recorder.summary()
+        if not rows:
+            st.write("まだ計測データはありません。")
+            return
+        st.table([
+            {
+                "区間": row['name'],
+                "単位": row['unit'],
+                "件数": row['count'],
+                "p50": f"{row['p50']:.1f}",
+                "p90": f"{row['p90']:.1f}",
+                "p99": f"{row['p99']:.1f}",
+                "最大": f"{row['max']:.1f}",
+            }
+            for row in rows
+        ])
+        col_download, col_refresh = st.columns(2)
+        col_download.download_button(
+            label="計測データを JSON Lines でダウンロード",
+            data=metrics.recorder.to_jsonl(),
+            file_name="hot_path_spans.jsonl",
+            mime="application/x-ndjson",
+        )
+        if col_refresh.button("更新", key="hot_path_refresh"):
+            st.rerun(scope="fragment")
+
+def resolve_usernames(storage: ChatStorage, text):
+    """カンマ区切りのユーザー名をユーザー ID のリストにする。見つからない名前は 2 つ目の戻り値で返す"""
+    user_ids, missing = [], []
+    for username in (name.strip() for name in text.replace("、", ",").split(",")):
+        if not username:
+            continue
+        user = storage.get_user(username)
+        if user:
+            user_ids.append(user['id'])
+        else:
+            missing.append(username)
+    return user_ids, missing
+
+def save_export_checkpoint(storage: ChatStorage, name, checkpoint):
+    """ダウンロードされたエクスポートの最後の行を、次回の「前回以降のみ」の起点として保存する"""
+    try:
+        storage.set_export_checkpoint(name, checkpoint)
+    except Exception as e:
+        print(f"エクスポートのチェックポイント保存エラー: {e}", file=sys.stderr)
+
+@st.fragment
+def research_export_panel(storage: ChatStorage):
+    """
+    研究用に全ユーザーのチャット履歴を一括エクスポートする。
+    保存先からページ単位で読みながら一時ファイルに書き出すので、履歴全体をメモリに載せない。
+    """
+    with st.expander("研究用データの一括エクスポート"):
+        usernames = st.text_input("ユーザー名（カンマ区切り、空欄なら全員）", key="bulk_export_usernames")
+        since = until = None
+        if st.checkbox("期間で絞り込む", key="bulk_export_use_dates"):
+            today = datetime.datetime.now(EXPORT_TIMEZONE).date()
+            date_range = st.date_input("期間（日本時間）", value=(today - datetime.timedelta(days=30), today), key="bulk_export_dates")
+            if date_range:
+                # 1 日だけ選んだ場合はその日だけを対象にする
+                start, end = date_range[0], date_range[-1]
+                if len(date_range) == 1:
+                    st.caption(f"{start} の 1 日分を対象にします。")
+                since = datetime.datetime.combine(start, datetime.time(), EXPORT_TIMEZONE).astimezone(datetime.timezone.utc).isoformat()
+                until = datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time(), EXPORT_TIMEZONE).astimezone(datetime.timezone.utc).isoformat()
+        export_format = st.radio("形式", list(bulk_export.EXPORT_FORMATS), horizontal=True, key="bulk_export_format")
+        incremental = st.checkbox("前回ダウンロードしたエクスポート（同じ対象ユーザー）以降の分のみ", key="bulk_export_incremental")
+
+        if st.button("一括エクスポートを作成", key="bulk_export_create"):
+            user_ids, missing = resolve_usernames(storage, usernames)
+            if missing:
+                st.error(f"見つからないユーザー: {', '.join(missing)}")
+                return
+            # このプロセスでまだ保存されていないメッセージを書き込んでから読む
+            get_history_writer(storage).flush()
+            name = bulk_export.checkpoint_name(user_ids)
+            after = storage.get_export_checkpoint(name) if incremental else None
+            write, file_name, mime = bulk_export.EXPORT_FORMATS[export_format]
+            pages = bulk_export.iter_message_pages(storage, after=after, since=since, until=until, user_ids=user_ids)
+            progress = st.empty()
+            output = tempfile.TemporaryFile()
+            try:
+                with metrics.span("export.bulk", format=export_format):
+                    result = write(pages, output, on_page=lambda r: progress.caption(f"{r.rows} 件を書き出しました…"))
+            except ImportError:
+                output.close()
+                st.error("Parquet 形式での書き出しには pyarrow が必要です。")
+                return
+            except Exception as e:
+                output.close()
+                st.error(f"エクスポートに失敗しました: {e}")
+                return
+            progress.empty()
+            previous = st.session_state.pop('bulk_export', None)
+            if previous is not None:
+                previous['file'].close()
+            st.session_state['bulk_export'] = {
+                'file': output, 'rows': result.rows, 'last': result.last,
+                'checkpoint_name': name, 'file_name': file_name, 'mime': mime,
+            }
+
+        export = st.session_state.get('bulk_export')
+        if export is None:
+            return
+        if not export['rows']:
+            st.info("条件に合う新しい履歴はありません。")
+            return
+        st.caption(f"{export['rows']} 件（最終: {export['last'][0]}）")
+        # 一時ファイルに書き出した圧縮済みのファイルを、ダウンロードボタンに渡すときだけ読み込む
+        export['file'].seek(0)
+        st.download_button(
+            label="一括エクスポートをダウンロード",
+            data=export['file'].read(),
+            file_name=export['file_name'],
+            mime=export['mime'],
+            on_click=save_export_checkpoint,
+            args=(storage, export['checkpoint_name'], export['last']),
+            key="bulk_export_download",
+        )
+
 # --- メインアプリケーション ---
 def main():
-    supabase = init_supabase_client()
+    storage = init_storage()
 
     if 'logged_in' not in st.session_state:
         st.session_state.logged_in = False
@@ -156,7 +1445,7 @@ def main():
                 password = st.text_input("パスワード", type="password")
                 submitted = st.form_submit_button("ログイン")
                 if submitted:
-                    user = verify_user(supabase, username, password) 
+                    user = verify_user(storage, username, password) 
                     if user:
                         st.session_state.logged_in = True
                         st.session_state.username = user['username']
@@ -174,254 +1463,96 @@ def main():
                 new_password = st.text_input("パスワード", type="password")
                 submitted = st.form_submit_button("登録")
                 if submitted and new_username.lower() != 'adminkaho1020':
-                    if add_user(supabase, new_username, new_password): 
+                    if add_user(storage, new_username, new_password): 
                         st.sidebar.success("登録が完了しました。ログインしてください。")
                     else:
                         st.sidebar.error("このユーザー名は既に使用されているか、登録に失敗しました。")
     else: 
         st.sidebar.success(f"{st.session_state.username} としてログイン中")
         if st.sidebar.button("ログアウト"):
+            schedule_learning_summary(storage)
+            if not get_history_writer(storage).flush():
+                st.sidebar.warning("一部のメッセージの保存が完了していません。")
             for key in list(st.session_state.keys()):
                 del st.session_state[key]
             st.rerun()
 
     if st.session_state.logged_in:
         if st.session_state.is_admin and not st.session_state.get('impersonating', False):
-            admin_panel(supabase) 
+            admin_panel(storage) 
             st.title("管理者ダッシュボード")
             st.info("サイドバーからユーザーを選択し、操作を行ってください。")
+            history_write_status(storage)
 
-            if 'viewing_messages' in st.session_state:
-                st.header(f"ユーザー「{st.session_state['viewing_username']}」の学習履歴")
-                messages_to_display = st.session_state['viewing_messages']
-                if not messages_to_display:
-                    st.write("このユーザーのチャット履歴はまだありません。")
-                else:
-                    for message in messages_to_display:
-                        with st.chat_message(message["role"]):
-                            st.markdown(message["content"])
+            admin_history_viewer(storage)
+            hot_path_dashboard(storage)
+            research_export_panel(storage)
         
         else:
             if st.session_state.get('impersonating', False):
                 st.info(f"現在、管理者として「{st.session_state.username}」でログインしています。")
                 if st.sidebar.button("管理者ビューに戻る"):
-                    st.session_state.user_id = st.session_state.admin_id
-                    st.session_state.username = st.session_state.admin_username
-                    st.session_state.is_admin = True
-                    st.session_state.impersonating = False
-                    if 'viewing_messages' in st.session_state:
-                        del st.session_state['viewing_messages']
-                    st.rerun()
+                    return_to_admin_view(storage)
             
             st.title("💬 チャットボットと学びを振り返ろう！")
             st.write("記入済みの学習日記フォーマットをDOCS形式でアップロードすると、その内容に関する対話ができます！")
 
-            try:
-                gemini_api_key = st.secrets["google_api_key"]
-                genai.configure(api_key=gemini_api_key)
-                
-                # ★★★ ベースシステムプロンプト（目標立ち返り＆URL誘導を追加） ★★★
-                base_system_prompt = """
-あなたはユーザーがアップロードしたファイル内の「学習目標」に精通した優秀な指導教員であり、独学する成人学習者の自己成長を支援する親しみやすいコーチングチャットボットです。
-
-### 0. リアルタイム・コンテキスト（動的注入データ）
-以下の情報はシステムによって自動更新されます。これらに基づいて回答を調整してください。
-
-<past_learning_record>
-・前回の主要な課題: {past_challenge}
-・前回達成したこと: {past_achievement}
-</past_learning_record>
-
-<user_status>
-・直近の入力の長さ: {input_length_status}
-・疲労フラグ: {fatigue_flag}
-</user_status>
-
----
-
-### 1. 最重要ルール：フェーズ制と疲労への配慮
-対話履歴の往復回数を確認し、以下のフェーズを厳密に守ってください。ただし、<user_status>の「疲労フラグ」が ON の場合は、即座にフェーズ3（終了）へ誘導してください。
-
-* **フェーズ1（1〜3往復目）：徹底的な内省（Step 1）**
-    - 目的：安易な解決策を出さず、ユーザーの思考を深く掘り下げる。
-    - 義務：3往復目の最後に「現在ステップ1/3が終了です。次は成長の振り返りですが、続けても大丈夫ですか？」と進捗を確認すること。
-
-* **フェーズ2（4〜6往復目）：視点の転換と過去比較（Step 2）**
-    - 目的：過去の自分（<past_learning_record>）と比較し、成長を実感させる。
-    - 義務：必ず「前回の課題であった〇〇が、今回は△△になっていますね」と言及すること。
-
-* **フェーズ3（7往復目以降、または終了希望時）：目標の再確認とクロージング（Step 3）**
-    - 目的：ドキュメント内の「学習目標」が現在も適切か確認し、次回の行動（Volition）を決める。
-    - 義務：目標の調整が必要な場合は、指定の目標設定アプリ（URL）を案内すること。
-
----
-
-### 2. 対話の進行プロセス（Step by Step）
-
-#### 【ステップ1：深掘り】
-ユーザーの回答に対し、「なぜ？」「具体的には？」と**最低2回以上**質問を重ねてください。
-※疲労フラグがON、または入力が極端に短い場合は、深掘りを中止して労りの言葉をかけてください。
-
-#### 【ステップ2：過去比較による自信の醸成】
-`<past_learning_record>` を参照し、以下の構成で話してください。
-1. **過去の引用:** 「前回は[課題]と仰っていましたが、」
-2. **成長の承認:** 「今回は[今回の気づき]ができていますね！素晴らしい進歩です。」
-※データが「データなし」の場合は、本日の対話の冒頭の発言と比較してください。
-
-#### 【ステップ3：目標の再確認とクロージング】
-次回の具体的な行動計画を決める前に、**アップロードされたドキュメント内の「学習目標」に言及し**、以下の対応を行ってください。
-1. **目標の確認:** 「現在の目標（〇〇）に対して、このまま進めて良いか、それとも目標自体の調整や練り直しが必要か」をユーザーに確認する。
-2. **URLの案内:** もしユーザーが「目標の調整や練り直しが必要だ」と判断した場合は、「では、一度目標設定をリセットしましょう」と伝え、**必ず以下のURLを案内**して再設定を勧めてください。
-   - 目標設定用チャットボット： https://learninggoal-chatbot.streamlit.app/
-3. **クロージング:** 最後に、次回のアクション（学習の継続、または目標の再設定）を宣言させ、「次回も楽しみにしています！」とポジティブに終了します。
-
----
-
-### 3. 禁止事項・スタンス
-* 直接的なアドバイスや正解の提示は行わない。
-* 専門的な質問には「一緒に調べましょう」または「検索を促す」に留める。
-* 常にARCS-Vモデルを意識し、自信（C）と意志（V）を高める声掛けを徹底する。
-"""
-            except Exception as e:
-                st.error(f"APIキーの設定でエラーが発生しました: {e}")
+            # google.generativeai の読み込みと設定は、最初に Gemini を使うとき（load_genai）に行う
+            if "google_api_key" not in st.secrets:
+                st.error("APIキーの設定でエラーが発生しました: google_api_key が Streamlit Secrets に設定されていません。")
                 st.stop()
             
             uploaded_file = st.file_uploader("ドキュメントをアップロードしてください", type=['txt', 'docx'])
 
             if "messages" not in st.session_state:
-                st.session_state.messages = get_messages_from_db(supabase, st.session_state.user_id) 
+                st.session_state.messages, st.session_state.history_cursor = get_messages_from_db(storage, st.session_state.user_id)
             if "document_content" not in st.session_state:
                 st.session_state.document_content = None
 
             if uploaded_file is not None and st.session_state.document_content is None:
                  try:
-                    if uploaded_file.type == 'text/plain':
-                        document_content = uploaded_file.getvalue().decode('utf-8')
-                    elif uploaded_file.type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
-                        document = docx.Document(uploaded_file)
-                        paragraphs = [p.text for p in document.paragraphs]
-                        document_content = "\n".join(paragraphs)
+                    file_bytes = uploaded_file.getvalue()
+                    digest = hashlib.sha256(file_bytes).hexdigest()
+                    document_content = extract_document_text(digest, file_bytes, uploaded_file.type)
                     
                     st.session_state.document_content = document_content
                     st.success("ドキュメントが正常にアップロードされました。")
                     st.info("これで、ドキュメントの内容について質問できます。")
                     
-                    initial_prompt = f"""
-あなたは今、システムプロンプト（役割定義）に従い、指導教員/コーチとして振る舞っています。
-学習者（ユーザー）が、以下の学習日記（ドキュメント）をアップロードしました。
-このドキュメントの内容を解釈し、システムプロンプトの「ステップ1」に従って、最初の応答（Botラリー1）を生成してください。
-ワンパターンな質問ではなく、日記の内容に具体的に言及し、回答しやすい具体的な問いかけを心がけてください。
-
----
-学習日記（ドキュメント）:
-{document_content}
----
-
-あなたの最初の応答を開始してください：
-"""
-                    
-                    with st.spinner("思考中です..."):
-                        p_data = get_past_learning_record(supabase, st.session_state.user_id)
-                        current_system_prompt = base_system_prompt.format(
-                            past_challenge=p_data['challenge'],
-                            past_achievement=p_data['achievement'],
-                            input_length_status="適切",
-                            fatigue_flag="OFF"
-                        )
-                        model = genai.GenerativeModel('gemini-2.5-flash', system_instruction=current_system_prompt)
-                        response = model.generate_content(initial_prompt)
+                    queue_placeholder = st.empty()
+                    try:
+                        with st.spinner("思考中です..."):
+                            p_data = get_past_learning_record(storage, st.session_state.user_id)
+                            current_system_prompt = render_system_prompt(
+                                p_data['challenge'], p_data['achievement'], "適切", "OFF"
+                            )
+                            assistant_message = generate_opening_response(
+                                digest, current_system_prompt, document_content,
+                                user_key=st.session_state.user_id, on_wait=queue_position_notifier(queue_placeholder)
+                            )
+                    finally:
+                        queue_placeholder.empty()
                     
-                    assistant_message = response.text
-                    st.session_state.messages.append({"role": "assistant", "content": assistant_message})
-                    add_message_to_db(supabase, st.session_state['user_id'], "assistant", assistant_message)
+                    # 同じ日記の再アップロードで、直前と同じ最初の応答を重ねて保存しない
+                    messages = st.session_state.messages
+                    if not (messages and messages[-1]["role"] == "assistant" and messages[-1]["content"] == assistant_message):
+                        append_session_message(storage, "assistant", assistant_message)
                     st.rerun()
                  except Exception as e:
-                    st.error(f"ファイルの読み込み中にエラーが発生しました: {e}")
-
-            for message in st.session_state.messages:
-                with st.chat_message(message["role"]):
-                    st.markdown(message["content"])
-
-            if prompt := st.chat_input("ドキュメントについて質問してください"):
-                st.session_state.messages.append({"role": "user", "content": prompt})
-                add_message_to_db(supabase, st.session_state.user_id, "user", prompt) 
-                with st.chat_message("user"):
-                    st.markdown(prompt)
+                    # 次のリランで最初の応答の作成からやり直せるよう、取り込んだ日記を破棄する
+                    st.session_state.document_content = None
+                    if is_rate_limit_error(e):
+                        st.error("現在アクセスが集中しています。少し時間をおいてから、もう一度アップロードしてください。")
+                    else:
+                        st.error(f"ファイルの読み込み中にエラーが発生しました: {e}")
 
-                try:
-                    input_len = len(prompt)
-                    input_length_status = "短い" if input_len < 10 else "適切"
-                    
-                    session_turn_count = len(st.session_state.messages)
-                    fatigue_flag = "ON" if (input_len < 10 and session_turn_count >= 6) else "OFF"
-
-                    p_data = get_past_learning_record(supabase, st.session_state.user_id)
-                    dynamic_system_prompt = base_system_prompt.format(
-                        past_challenge=p_data['challenge'],
-                        past_achievement=p_data['achievement'],
-                        input_length_status=input_length_status,
-                        fatigue_flag=fatigue_flag
-                    )
-
-                    model = genai.GenerativeModel('gemini-2.5-flash', system_instruction=dynamic_system_prompt)
-
-                    history = []
-                    document_context = f"参考：ユーザーの学習日記（ドキュメント）:\n{st.session_state.get('document_content', 'ドキュメントなし')}"
-                    history.append({'role': 'user', 'parts': [document_context]})
-                    history.append({'role': 'model', 'parts': ["（承知しました。学習日記を再度参照します。）"]})
-
-                    for msg in st.session_state.messages:
-                        role = "user" if msg["role"] == "user" else "model"
-                        history.append({'role': role, 'parts': [msg["content"]]})
-                    
-                    response_stream = model.generate_content(history, stream=True)
-
-                    full_response = ""
-                    with st.chat_message("assistant"):
-                        message_placeholder = st.empty()
-                        for chunk in response_stream:
-                            if chunk.parts:
-                                text_part = chunk.parts[0].text
-                                full_response += text_part
-                                message_placeholder.markdown(full_response + "▌")
-                        message_placeholder.markdown(full_response)
-                    
-                    st.session_state.messages.append({"role": "assistant", "content": full_response})
-                    add_message_to_db(supabase, st.session_state.user_id, "assistant", full_response) 
-
-                except Exception as e:
-                    st.error("エラーが発生しました。詳細はコンソールを確認してください。")
-                    print(f"エラーの詳細: {e}", file=sys.stderr)
-                    error_message = "申し訳ありません、応答の生成中にエラーが発生しました。"
-                    st.session_state.messages.append({"role": "assistant", "content": error_message})
-                    add_message_to_db(supabase, st.session_state.user_id, "assistant", error_message) 
-            
-            st.sidebar.header("エクスポート")
-            doc = docx.Document()
-            doc.add_heading(f'{st.session_state["username"]}さんの振り返り', 0)
-            for message in st.session_state.messages:
-                role_jp = "ユーザー" if message["role"] == "user" else "チャットボット"
-                doc.add_paragraph(f"{role_jp}: {message['content']}")
-            doc_io = io.BytesIO()
-            doc.save(doc_io)
-            doc_io.seek(0)
-            st.sidebar.download_button(
-                label="振り返りをWord形式でダウンロード",
-                data=doc_io,
-                file_name=f"{st.session_state['username']}_振り返り.docx",
-                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-            )
-            if st.session_state.messages:
-                df = pd.DataFrame(st.session_state.messages)
-                csv = df.to_csv(index=False).encode('utf-8')
-                st.sidebar.download_button(
-                    label="対話履歴をCSV形式でダウンロード",
-                    data=csv,
-                    file_name=f"{st.session_state['username']}_対話履歴.csv",
-                    mime="text/csv",
-                )
+            chat_history_pane(storage)
+            chat_turn_pane(storage)
+            with st.sidebar:
+                export_panel(storage)
     else:
         st.info("チャットボットを利用するには、サイドバーからログインまたは新規登録をしてください。")
 
 if __name__ == '__main__':
-    main()
+    with metrics.span("rerun.main"):
+        main()
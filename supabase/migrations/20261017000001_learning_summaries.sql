@@ -0,0 +1,12 @@
+-- セッションごとの学習記録（課題と達成したこと）。次回のシステムプロンプトに前回の記録として差し込む。
+create table if not exists learning_summaries (
+    id bigint generated by default as identity primary key,
+    user_id bigint not null references users (id) on delete cascade,
+    challenge text,
+    achievement text,
+    created_at timestamptz not null default now()
+);
+
+-- 最新の 1 件の取得（latest_learning_summary）とユーザーごとの件数（user_directory）に使う
+create index if not exists learning_summaries_user_created
+    on learning_summaries (user_id, created_at desc);
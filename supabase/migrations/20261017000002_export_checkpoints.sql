@@ -0,0 +1,11 @@
+-- 研究用一括エクスポートの「前回以降のみ」の起点。対象ユーザーごとに、最後に書き出した行の (timestamp, id) を保持する。
+create table if not exists export_checkpoints (
+    name text primary key,
+    last_timestamp timestamptz not null,
+    last_id bigint not null,
+    updated_at timestamptz not null default now()
+);
+
+-- 全ユーザーの履歴を (timestamp, id) のキーセットでページ単位に読む（get_messages_page）ために使う
+create index if not exists chat_history_timestamp
+    on chat_history (timestamp, id);
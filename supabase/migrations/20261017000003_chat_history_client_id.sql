@@ -0,0 +1,6 @@
+-- 履歴の書き込みを再試行しても行が重複しないよう、アプリが行ごとに付ける id。
+-- insert_messages は client_id が既にある行を追加しない（upsert ... on conflict do nothing）。
+alter table chat_history add column if not exists client_id uuid;
+
+create unique index if not exists chat_history_client_id
+    on chat_history (client_id);
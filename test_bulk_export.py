@@ -0,0 +1,79 @@
+"""
+一括エクスポートのページ読み込みと書き出しの確認。SQLiteStorage(':memory:') を使い、ネットワークなしで動く。
+
+使い方:
+    python -m unittest test_bulk_export
+"""
+import csv
+import datetime
+import io
+import unittest
+import zipfile
+
+import bulk_export
+import storage
+
+
+class CappedStorage:
+    """Supabase の db-max-rows のように、1 回に返す行数を max_rows 件までに切り詰める"""
+
+    def __init__(self, backend, max_rows):
+        self.backend = backend
+        self.max_rows = max_rows
+        self.calls = 0
+
+    def get_messages_page(self, limit, after=None, since=None, until=None, user_ids=None):
+        self.calls += 1
+        return self.backend.get_messages_page(min(limit, self.max_rows), after, since, until, user_ids)
+
+
+class IterMessagePagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = storage.SQLiteStorage(':memory:')
+        self.backend.add_user('a', 'x')
+        user_id = self.backend.get_user('a')['id']
+        base = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        self.backend.insert_messages([
+            {
+                'user_id': user_id,
+                'role': 'user',
+                'content': f"メッセージ {i}",
+                'timestamp': (base + datetime.timedelta(seconds=i)).isoformat(),
+            }
+            for i in range(2500)
+        ])
+
+    def test_capped_backend_is_read_to_the_end(self):
+        capped = CappedStorage(self.backend, max_rows=500)
+        pages = list(bulk_export.iter_message_pages(capped, page_size=1000))
+
+        self.assertEqual([len(rows) for rows in pages], [500] * 5)
+        ids = [row['id'] for rows in pages for row in rows]
+        self.assertEqual(len(set(ids)), 2500)
+        # 最後のページの後に空のページを 1 回読んで終わる
+        self.assertEqual(capped.calls, 6)
+
+    def test_resume_after_checkpoint(self):
+        first = next(bulk_export.iter_message_pages(self.backend, page_size=1000))
+        after = (first[-1]['timestamp'], first[-1]['id'])
+        rest = [row for rows in bulk_export.iter_message_pages(self.backend, page_size=1000, after=after) for row in rows]
+
+        self.assertEqual(len(rest), 1500)
+        self.assertEqual(rest[0]['content'], "メッセージ 1000")
+
+    def test_write_csv_zip(self):
+        buffer = io.BytesIO()
+        result = bulk_export.write_csv_zip(bulk_export.iter_message_pages(self.backend, page_size=1000), buffer)
+
+        self.assertEqual(result.rows, 2500)
+        with zipfile.ZipFile(buffer) as archive:
+            text = archive.read('chat_history.csv').decode('utf-8-sig')
+        rows = list(csv.reader(io.StringIO(text)))
+        self.assertEqual(tuple(rows[0]), bulk_export.EXPORT_COLUMNS)
+        self.assertEqual(len(rows), 2501)
+        self.assertEqual(result.last, (rows[-1][5], int(rows[-1][0])))
+
+
+if __name__ == '__main__':
+    unittest.main()
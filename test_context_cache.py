@@ -0,0 +1,71 @@
+"""
+ContextCacheRegistry のヒット／ミスの確認。fakes.FakeCachingClient を使い、ネットワークなしで動く。
+
+使い方:
+    python -m unittest test_context_cache
+"""
+import unittest
+
+import fakes
+from streamlit_app import ContextCacheRegistry
+
+SYSTEM_PROMPT = "あなたは学習を振り返るコーチです。" * 20
+DIARY = "今日は英単語を 20 個覚えた。発音が難しかった。" * 20
+
+
+class ContextCacheRegistryTest(unittest.TestCase):
+
+    def test_miss_then_hit(self):
+        client = fakes.FakeCachingClient()
+        registry = ContextCacheRegistry(client)
+
+        first = registry.get_model(SYSTEM_PROMPT, DIARY)
+        second = registry.get_model(SYSTEM_PROMPT, DIARY)
+
+        self.assertIsNotNone(first)
+        self.assertIs(first.cached_content, second.cached_content)
+        self.assertEqual(len(client.created), 1)
+        self.assertEqual((registry.hits, registry.misses), (1, 1))
+
+    def test_other_diary_is_a_miss(self):
+        client = fakes.FakeCachingClient()
+        registry = ContextCacheRegistry(client)
+
+        registry.get_model(SYSTEM_PROMPT, DIARY)
+        registry.get_model(SYSTEM_PROMPT, DIARY + "追記")
+
+        self.assertEqual(len(client.created), 2)
+        self.assertEqual((registry.hits, registry.misses), (0, 2))
+
+    def test_too_small_falls_back_without_retrying(self):
+        client = fakes.FakeCachingClient(min_chars=10 ** 6)
+        registry = ContextCacheRegistry(client)
+
+        self.assertIsNone(registry.get_model(SYSTEM_PROMPT, DIARY))
+        self.assertIsNone(registry.get_model(SYSTEM_PROMPT, DIARY))
+        # 2 回目は作成を試みない
+        self.assertEqual(registry.misses, 1)
+
+    def test_transient_error_is_retried(self):
+        client = fakes.FakeCachingClient()
+        client.fail_next = RuntimeError("429 Resource has been exhausted")
+        registry = ContextCacheRegistry(client)
+
+        self.assertIsNone(registry.get_model(SYSTEM_PROMPT, DIARY))
+        self.assertIsNotNone(registry.get_model(SYSTEM_PROMPT, DIARY))
+        self.assertEqual(len(client.created), 1)
+
+    def test_entries_are_bounded(self):
+        client = fakes.FakeCachingClient()
+        registry = ContextCacheRegistry(client, max_entries=2)
+
+        for i in range(5):
+            registry.get_model(SYSTEM_PROMPT, f"{DIARY}{i}")
+
+        self.assertEqual(len(registry._entries), 2)
+        registry.get_model(SYSTEM_PROMPT, f"{DIARY}4")
+        self.assertEqual(registry.hits, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""
+LLMDispatcher の同時実行数の制限と、ユーザーごとに順番に枠を割り当てる動作の確認。
+
+使い方:
+    python -m unittest test_dispatcher
+"""
+import threading
+import time
+import unittest
+
+from dispatcher import LLMDispatcher
+
+
+class RateLimitError(Exception):
+    code = 429
+
+
+def queued(dispatcher):
+    with dispatcher._condition:
+        return sum(len(tickets) for tickets in dispatcher._queues.values())
+
+
+class LLMDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = LLMDispatcher(max_concurrency=1, backoff=0.01)
+        self.order = []
+        self.positions = {}
+        self.threads = []
+
+    def submit(self, user_key, label):
+        """label を記録する呼び出しを別スレッドで順番待ちに並べ、並び終わるまで待つ"""
+        expected = queued(self.dispatcher) + 1
+        positions = self.positions.setdefault(label, [])
+        thread = threading.Thread(
+            target=self.dispatcher.call,
+            args=(user_key, lambda: self.order.append(label), positions.append),
+        )
+        thread.start()
+        self.threads.append(thread)
+        self.wait_for(lambda: queued(self.dispatcher) >= expected)
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.001)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+    def test_waiting_calls_are_granted_round_robin_per_user(self):
+        holder = self.dispatcher.acquire('holder')
+        for label in ('a1', 'a2', 'a3'):
+            self.submit('a', label)
+        self.submit('b', 'b1')
+        self.submit('c', 'c1')
+
+        self.dispatcher.release(holder)
+        self.join()
+
+        # 先に 3 件並べた a が枠を使い続けず、b・c の呼び出しが間に入る
+        self.assertEqual(self.order, ['a1', 'b1', 'c1', 'a2', 'a3'])
+        self.assertEqual(self.dispatcher.active, 0)
+
+    def test_on_wait_reports_position_in_grant_order(self):
+        holder = self.dispatcher.acquire('holder')
+        self.submit('a', 'a1')
+        self.submit('a', 'a2')
+        self.submit('b', 'b1')
+
+        # b1 は後から並んだが、a2 より先に枠が割り当てられる
+        self.wait_for(lambda: self.positions['b1'] == [1] and self.positions['a2'][-1:] == [2])
+
+        self.dispatcher.release(holder)
+        self.join()
+        self.assertEqual(self.order, ['a1', 'b1', 'a2'])
+
+    def test_rate_limit_errors_are_retried(self):
+        attempts = []
+
+        def flaky():
+            attempts.append(None)
+            if len(attempts) < 3:
+                raise RateLimitError("429 Resource has been exhausted")
+            return "ok"
+
+        self.assertEqual(self.dispatcher.call('a', flaky), "ok")
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(self.dispatcher.rate_limited, 2)
+        self.assertEqual(self.dispatcher.active, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+ChatHistoryWriter の再試行・分割書き込みの確認。SQLiteStorage(':memory:') を使い、ネットワークなしで動く。
+
+使い方:
+    python -m unittest test_history_writer
+"""
+import sqlite3
+import time
+import unittest
+
+import storage
+from streamlit_app import ChatHistoryWriter
+
+
+class LostResponseStorage:
+    """最初の書き込みは保存先に反映したうえで、応答が届かなかったかのようにタイムアウトを送出する"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = 0
+
+    def insert_messages(self, rows):
+        self.calls += 1
+        inserted = self.backend.insert_messages(rows)
+        if self.calls == 1:
+            raise TimeoutError("read timed out")
+        return inserted
+
+
+class RejectingStorage:
+    """content が 'bad' の行を含むバッチを、制約違反として拒否する"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = 0
+
+    def insert_messages(self, rows):
+        self.calls += 1
+        if any(row['content'] == 'bad' for row in rows):
+            raise sqlite3.IntegrityError("CHECK constraint failed")
+        return self.backend.insert_messages(rows)
+
+
+class AlwaysFailingStorage:
+    def __init__(self):
+        self.calls = 0
+
+    def insert_messages(self, rows):
+        self.calls += 1
+        raise ConnectionError("connection refused")
+
+
+def make_row(user_id, index, content=None):
+    return {
+        'user_id': user_id,
+        'role': 'user',
+        'content': content or f"メッセージ {index}",
+        'timestamp': f"2024-01-01T00:00:{index:02d}+00:00",
+        'client_id': f"client-{user_id}-{index}",
+    }
+
+
+class ChatHistoryWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = storage.SQLiteStorage(':memory:')
+        self.backend.add_user('a', 'x')
+        self.backend.add_user('b', 'x')
+        self.user_a = self.backend.get_user('a')['id']
+        self.user_b = self.backend.get_user('b')['id']
+
+    def stored(self, user_id):
+        return self.backend.get_messages(user_id, 100)
+
+    def test_retry_after_lost_response_does_not_duplicate(self):
+        target = LostResponseStorage(self.backend)
+        writer = ChatHistoryWriter(target, flush_interval=0.05, backoff=0.01)
+        for i in range(3):
+            writer.enqueue(make_row(self.user_a, i))
+
+        self.assertTrue(writer.flush())
+        self.assertEqual(target.calls, 2)
+        self.assertEqual(len(self.stored(self.user_a)), 3)
+        self.assertEqual(writer.failed_rows, 0)
+
+    def test_bad_row_does_not_drop_other_users_rows(self):
+        target = RejectingStorage(self.backend)
+        writer = ChatHistoryWriter(target, flush_interval=0.2, backoff=0.01)
+        for i in range(20):
+            user_id = self.user_a if i % 2 else self.user_b
+            writer.enqueue(make_row(user_id, i, 'bad' if i == 7 else None))
+
+        self.assertTrue(writer.flush())
+        self.assertEqual(len(self.stored(self.user_a)) + len(self.stored(self.user_b)), 19)
+        self.assertEqual(writer.failed_rows, 1)
+        self.assertEqual(writer.failed_count(self.user_a), 1)
+        self.assertEqual(writer.failed_count(self.user_b), 0)
+        # 制約違反は再試行せず、分割して原因の行だけを見つける
+        self.assertLess(target.calls, 20)
+
+    def test_transient_errors_are_retried_then_reported(self):
+        target = AlwaysFailingStorage()
+        writer = ChatHistoryWriter(target, flush_interval=0.05, max_retries=3, backoff=0.1)
+        writer.enqueue(make_row(self.user_a, 0))
+
+        started = time.monotonic()
+        self.assertTrue(writer.flush())
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(target.calls, 3)
+        self.assertEqual(writer.failed_rows, 1)
+        self.assertIsInstance(writer.last_error, ConnectionError)
+        # 待つのは再試行の前だけ（0.1 + 0.2 秒）。最後の失敗の後にも待つと 0.4 秒多くかかる
+        self.assertLess(elapsed, 0.6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+CachedStorage の読み取りキャッシュの確認。SQLiteStorage(':memory:') を使い、ネットワークなしで動く。
+
+使い方:
+    python -m unittest test_storage
+"""
+import datetime
+import unittest
+
+import storage
+
+
+class CountingStorage:
+    """get_messages の呼び出し回数を数える。それ以外はそのまま backend に渡す"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.reads = 0
+
+    def get_messages(self, user_id, limit, before=None):
+        self.reads += 1
+        return self.backend.get_messages(user_id, limit, before)
+
+    def insert_messages(self, rows):
+        return self.backend.insert_messages(rows)
+
+
+def make_rows(user_id, start, count):
+    base = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    return [
+        {
+            'user_id': user_id,
+            'role': 'user',
+            'content': f"メッセージ {i}",
+            'timestamp': (base + datetime.timedelta(seconds=i)).isoformat(),
+        }
+        for i in range(start, start + count)
+    ]
+
+
+def cursor_of(row):
+    return (row['timestamp'], row['id'])
+
+
+class CachedStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        backend = storage.SQLiteStorage(':memory:')
+        backend.add_user('a', 'x')
+        self.user_id = backend.get_user('a')['id']
+        backend.insert_messages(make_rows(self.user_id, 0, 25))
+        self.backend = CountingStorage(backend)
+        self.cache = storage.CachedStorage(self.backend, ttl_seconds=60)
+
+    def read_pages(self, limit):
+        """get_messages_from_db と同じく limit + 1 件ずつ読み、最後のページまでの行を新しい順に返す"""
+        rows, before = [], None
+        while True:
+            page = self.cache.get_messages(self.user_id, limit + 1, before)
+            rows.extend(page[:limit])
+            if len(page) <= limit:
+                return rows
+            before = cursor_of(page[limit - 1])
+
+    def test_limit_plus_one_paging_is_cached(self):
+        first = self.read_pages(10)
+        reads = self.backend.reads
+        self.assertEqual(len(first), 25)
+        self.assertEqual(reads, 3)
+
+        # 2 回目はどのページもキャッシュから返る
+        self.assertEqual(self.read_pages(10), first)
+        self.assertEqual(self.backend.reads, reads)
+
+    def test_inserted_rows_are_written_through(self):
+        self.read_pages(10)
+        reads = self.backend.reads
+        self.cache.insert_messages(make_rows(self.user_id, 100, 1))
+
+        newest = self.cache.get_messages(self.user_id, 11)
+        self.assertEqual(newest[0]['content'], "メッセージ 100")
+        self.assertEqual(self.backend.reads, reads)
+
+    def test_stale_cache_is_revalidated(self):
+        self.cache.ttl_seconds = 0
+        self.cache.get_messages(self.user_id, 11)
+        # キャッシュを通さずに（別のプロセスから）追加された行
+        self.backend.insert_messages(make_rows(self.user_id, 100, 1))
+
+        newest = self.cache.get_messages(self.user_id, 11)
+        self.assertEqual(newest[0]['content'], "メッセージ 100")
+        self.assertEqual(len(newest), 11)
+
+
+if __name__ == '__main__':
+    unittest.main()